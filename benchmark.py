@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+"""
+Benchmarks the extraction scripts on synthetic inputs of configurable
+size, and compares the results with a stored baseline.
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from subprocess import DEVNULL, Popen
+from xml.sax.saxutils import escape
+from hearthstone.enums import Locale
+
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BASEDIR, "benchmark-baseline.json")
+
+LOCALES = ["enUS"] + sorted(loc for loc in Locale.__members__ if loc not in ("UNKNOWN", "enUS"))
+
+TEXTS = [
+	"<b>Battlecry:</b> Deal %i damage.",
+	"<b>Overload:</b> (%i)",
+	"<b>Spell Damage +%i</b>",
+	"Draw %i cards.",
+	"Can't attack.",
+	"Restore %i Health to all friendly characters.",
+	"",
+]
+
+
+def make_cards(rng, count, start=1):
+	"""
+	Return a dict of card id -> card of \a count synthetic cards.
+	"""
+	ret = {}
+	for dbf_id in range(start, start + count):
+		id = "BENCH_%06i" % (dbf_id)
+		ret[id] = {
+			"dbf_id": dbf_id,
+			"name": "Card %i" % (dbf_id),
+			"text": rng.choice(TEXTS).replace("%i", str(rng.randint(1, 10))),
+			"cost": rng.randint(0, 10),
+			"atk": rng.randint(0, 12),
+			"health": rng.randint(1, 12),
+		}
+	return ret
+
+
+def mutate_cards(rng, cards, rate):
+	"""
+	Return a copy of \a cards where a \a rate fraction of the cards
+	changed, and about a quarter as many were deleted and added.
+	"""
+	ret = {}
+	for id, card in cards.items():
+		if rng.random() < rate / 4:
+			continue
+		card = dict(card)
+		if rng.random() < rate:
+			card["cost"] = (card["cost"] + 1) % 11
+			card["text"] = rng.choice(TEXTS).replace("%i", str(rng.randint(1, 10)))
+		ret[id] = card
+	start = max(card["dbf_id"] for card in cards.values()) + 1
+	ret.update(make_cards(rng, int(len(cards) * rate / 4), start))
+	return ret
+
+
+def localize(text, locale):
+	if not text or locale == "enUS":
+		return text
+	return "%s (%s)" % (text, locale)
+
+
+def write_entity_tags(f, card, locale):
+	f.write('\t\t<Tag enumID="185" name="CARDNAME" type="String">%s</Tag>\n' % (
+		escape(localize(card["name"], locale))
+	))
+	if card["text"]:
+		f.write('\t\t<Tag enumID="184" name="CARDTEXT_INHAND" type="String">%s</Tag>\n' % (
+			escape(localize(card["text"], locale))
+		))
+
+
+def write_locale_xml(path, cards, locale):
+	"""
+	Write \a cards as the single-locale CardDefs found in the bundles.
+	"""
+	with open(path, "w", encoding="utf-8") as f:
+		f.write("<CardDefs>\n")
+		for id, card in sorted(cards.items()):
+			f.write('\t<Entity CardID="%s" version="2">\n' % (id))
+			write_entity_tags(f, card, locale)
+			f.write('\t</Entity>\n')
+		f.write("</CardDefs>\n")
+
+
+def write_carddefs(path, cards, locales):
+	"""
+	Write \a cards as a processed, merged-locales CardDefs.xml.
+	"""
+	with open(path, "w", encoding="utf-8") as f:
+		f.write('<?xml version="1.0" encoding="UTF-8"?>\n<CardDefs build="0">\n')
+		for id, card in sorted(cards.items()):
+			f.write('\t<Entity CardID="%s" ID="%i" version="2">\n' % (id, card["dbf_id"]))
+			for enum_id, name, key in ((185, "CARDNAME", "name"), (184, "CARDTEXT_INHAND", "text")):
+				if not card[key]:
+					continue
+				f.write('\t\t<Tag enumID="%i" name="%s" type="String">\n' % (enum_id, name))
+				for locale in locales:
+					f.write("\t\t\t<%s>%s</%s>\n" % (locale, escape(localize(card[key], locale)), locale))
+				f.write("\t\t</Tag>\n")
+			for enum_id, name, key in ((48, "COST", "cost"), (47, "ATK", "atk"), (45, "HEALTH", "health")):
+				f.write('\t\t<Tag enumID="%i" name="%s" type="Int" value="%i"/>\n' % (enum_id, name, card[key]))
+			f.write("\t</Entity>\n")
+		f.write("</CardDefs>\n")
+
+
+def write_dbf(path, name, columns, records):
+	with open(path, "w", encoding="utf-8") as f:
+		f.write('<Dbf name="%s">\n' % (name))
+		for column, type in columns:
+			f.write('\t<Column name="%s" type="%s"/>\n' % (column, type))
+		for record in records:
+			f.write("\t<Record>\n")
+			for (column, type), value in zip(columns, record):
+				f.write('\t\t<Field column="%s">%s</Field>\n' % (column, escape(str(value))))
+			f.write("\t</Record>\n")
+		f.write("</Dbf>\n")
+
+
+def write_dbfs(path, cards):
+	os.makedirs(path, exist_ok=True)
+	cards = sorted(cards.items(), key=lambda item: item[1]["dbf_id"])
+	write_dbf(
+		os.path.join(path, "CARD.xml"), "CARD",
+		[("ID", "Int"), ("NOTE_MINI_GUID", "String"), ("LONG_GUID", "String")],
+		[(card["dbf_id"], id, "guid-" + id) for id, card in cards]
+	)
+
+	columns = [
+		("ID", "Int"), ("CARD_ID", "Int"), ("TAG_ID", "Int"), ("TAG_VALUE", "Int"),
+		("IS_REFERENCE_TAG", "Bool"), ("IS_POWER_KEYWORD_TAG", "Bool"),
+	]
+	records = []
+	for id, card in cards:
+		for tag_id, key in ((48, "cost"), (47, "atk"), (45, "health")):
+			records.append((len(records) + 1, card["dbf_id"], tag_id, card[key], "False", "False"))
+	write_dbf(os.path.join(path, "CARD_TAG.xml"), "CARD_TAG", columns, records)
+
+
+def write_raw_bundle(path, xml_paths, padding=64 * 1024):
+	"""
+	Write a fake bundle embedding the CardDefs blocks of \a xml_paths,
+	each preceded by its locale name, like those read by
+	cardxml_raw_extract.py.
+	"""
+	with open(path, "wb") as f:
+		for locale, xml_path in xml_paths:
+			f.write(b"\0" * padding)
+			f.write(locale.encode("utf-8") + b"\0\0\0\0")
+			with open(xml_path, "rb") as xml:
+				shutil.copyfileobj(xml, f)
+		f.write(b"\0" * padding)
+
+
+def ingest_files(store_path, *paths):
+	"""
+	Add the files at \a paths to the extract_mpq ObjectStore at \a store_path.
+	"""
+	from extract_mpq import ObjectStore
+
+	store = ObjectStore(store_path)
+	for path in paths:
+		with open(path, "rb") as f:
+			store.add(f, os.path.getsize(path))
+
+
+class Inputs:
+	"""
+	Synthetic inputs for two consecutive builds, "old" and "new".
+	"""
+	def __init__(self, path, entities, locales, change_rate, seed):
+		self.path = path
+		self.locales = LOCALES[:locales]
+		rng = random.Random(seed)
+		self.cards = {"old": make_cards(rng, entities)}
+		self.cards["new"] = mutate_cards(rng, self.cards["old"], change_rate)
+
+	def build_dir(self, build):
+		return os.path.join(self.path, build)
+
+	def locale_xmls(self, build):
+		return [os.path.join(self.build_dir(build), "%s.xml" % (locale)) for locale in self.locales]
+
+	def generate(self):
+		for build, cards in self.cards.items():
+			path = self.build_dir(build)
+			os.makedirs(path, exist_ok=True)
+			for locale, xml_path in zip(self.locales, self.locale_xmls(build)):
+				write_locale_xml(xml_path, cards, locale)
+			write_dbfs(os.path.join(path, "DBF"), cards)
+			write_carddefs(os.path.join(path, "CardDefs.xml"), cards, self.locales)
+
+		os.makedirs(os.path.join(self.path, "raw"), exist_ok=True)
+		write_raw_bundle(
+			os.path.join(self.path, "raw", "cards0.unity3d"),
+			list(zip(self.locales, self.locale_xmls("new")))
+		)
+
+
+class Benchmark:
+	"""
+	A command timed on the inputs, processing \a items units of work.
+	The \a setup commands run untimed before every run.
+	"""
+	def __init__(self, name, command, items, unit, cwd=None, setup=()):
+		self.name = name
+		self.command = command
+		self.items = items
+		self.unit = unit
+		self.cwd = cwd
+		self.setup = setup
+
+
+def get_benchmarks(inputs):
+	python = sys.executable
+	process_cardxml = os.path.join(BASEDIR, "process_cardxml.py")
+	old, new = inputs.build_dir("old"), inputs.build_dir("new")
+	entities = len(inputs.cards["new"])
+	state = os.path.join(inputs.path, "old.state")
+	store = os.path.join(inputs.path, "store")
+	bundle = os.path.join(inputs.path, "raw", "cards0.unity3d")
+
+	def process_command(build, *args):
+		return [
+			python, process_cardxml, "--raw", "--build", "15590", "--no-dbf-cache",
+			"--dbf-dir", os.path.join(inputs.build_dir(build), "DBF"),
+			"-o", os.path.join(inputs.build_dir(build), "processed.xml"),
+		] + inputs.locale_xmls(build) + list(args)
+
+	return [
+		Benchmark("process_cardxml", process_command("new"), entities, "entities"),
+		Benchmark(
+			"process_cardxml_jobs", process_command("new", "--jobs", str(min(len(inputs.locales), 4))),
+			entities, "entities"
+		),
+		Benchmark(
+			"process_cardxml_incremental", process_command("new", "--base", state), entities, "entities",
+			setup=[process_command("old", "--save-state", state)]
+		),
+		Benchmark(
+			"cardxml_raw_extract", [python, os.path.join(BASEDIR, "cardxml_raw_extract.py"), bundle],
+			os.path.getsize(bundle) / (1024 * 1024), "MB", cwd=os.path.join(inputs.path, "raw")
+		),
+		Benchmark(
+			"smartdiff_cardxml", [
+				python, os.path.join(BASEDIR, "smartdiff_cardxml.py"), "--no-cache",
+				os.path.join(old, "CardDefs.xml"), os.path.join(new, "CardDefs.xml"),
+			], entities, "entities"
+		),
+		Benchmark(
+			"extract_mpq_store", [python, os.path.abspath(__file__), "--ingest", store] + inputs.locale_xmls("new"),
+			sum(os.path.getsize(path) for path in inputs.locale_xmls("new")) / (1024 * 1024), "MB",
+			setup=[[python, "-c", "import shutil; shutil.rmtree(%r, ignore_errors=True)" % (store)]]
+		),
+	]
+
+
+def run_command(command, cwd=None, log=None):
+	"""
+	Run \a command and return its (exit code, wall time, peak RSS in bytes).
+	"""
+	start = time.perf_counter()
+	proc = Popen(command, cwd=cwd, stdout=DEVNULL, stderr=log)
+	# wait4() reports the peak RSS of the command and all its children
+	pid, status, rusage = os.wait4(proc.pid, 0)
+	proc.returncode = os.waitstatus_to_exitcode(status)
+	elapsed = time.perf_counter() - start
+	# ru_maxrss is in kilobytes, except on macOS
+	unit = 1 if sys.platform == "darwin" else 1024
+	return proc.returncode, elapsed, rusage.ru_maxrss * unit
+
+
+def run_benchmark(benchmark, repeat, log_path):
+	"""
+	Run \a benchmark \a repeat times and return the result of its
+	fastest run, or None if it failed.
+	"""
+	best = None
+	with open(log_path, "wb") as log:
+		for i in range(repeat):
+			for command in benchmark.setup:
+				if run_command(command, benchmark.cwd, log)[0] != 0:
+					return None
+			code, elapsed, peak_rss = run_command(benchmark.command, benchmark.cwd, log)
+			if code != 0:
+				return None
+			if best is None or elapsed < best["seconds"]:
+				best = {"seconds": elapsed, "peak_rss": peak_rss}
+			else:
+				best["peak_rss"] = max(best["peak_rss"], peak_rss)
+
+	best["throughput"] = benchmark.items / best["seconds"]
+	best["unit"] = benchmark.unit
+	return best
+
+
+def compare(name, result, baseline, threshold):
+	"""
+	Return the list of regressions of \a result against \a baseline.
+	"""
+	ret = []
+	for key, label, scale, unit in (("seconds", "time", 1, "s"), ("peak_rss", "peak RSS", 1024 * 1024, " MB")):
+		before, after = baseline[key], result[key]
+		if before and after > before * (1 + threshold):
+			ret.append("%s: %s went from %.3f%s to %.3f%s (%+.0f%%)" % (
+				name, label, before / scale, unit, after / scale, unit, (after / before - 1) * 100
+			))
+	return ret
+
+
+def main():
+	p = ArgumentParser()
+	p.add_argument("benchmarks", nargs="*", help="Only run these benchmarks")
+	p.add_argument("--entities", type=int, default=5000)
+	p.add_argument("--locales", type=int, default=len(LOCALES), help="Up to %i" % (len(LOCALES)))
+	p.add_argument(
+		"--change-rate", type=float, default=0.05,
+		help="Fraction of the cards changed between the two builds"
+	)
+	p.add_argument("--seed", type=int, default=1)
+	p.add_argument("--repeat", type=int, default=3, help="Runs of each benchmark, the fastest is kept")
+	p.add_argument("--workdir", type=str, help="Where to generate the inputs (default: a temporary directory)")
+	p.add_argument("--baseline", type=str, default=DEFAULT_BASELINE)
+	p.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+	p.add_argument(
+		"--threshold", type=float, default=0.2,
+		help="Relative slowdown or memory increase counted as a regression"
+	)
+	p.add_argument("--ingest", nargs="+", metavar="STORE FILE", help=ingest_files.__doc__)
+	args = p.parse_args()
+
+	if args.ingest:
+		ingest_files(*args.ingest)
+		return
+
+	workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark-")
+	params = {
+		"entities": args.entities,
+		"locales": args.locales,
+		"change_rate": args.change_rate,
+		"seed": args.seed,
+	}
+
+	try:
+		print("Generating inputs in %r" % (workdir))
+		inputs = Inputs(workdir, **params)
+		inputs.generate()
+
+		results = {}
+		failed = []
+		for benchmark in get_benchmarks(inputs):
+			if args.benchmarks and benchmark.name not in args.benchmarks:
+				continue
+			log_path = os.path.join(workdir, benchmark.name + ".log")
+			result = run_benchmark(benchmark, args.repeat, log_path)
+			if result is None:
+				with open(log_path, "r", errors="replace") as f:
+					log = f.read()
+				print("%-28s FAILED\n%s" % (benchmark.name, log[-2000:]))
+				failed.append(benchmark.name)
+				continue
+			results[benchmark.name] = result
+			print("%-28s %8.3fs %12.1f %s/s %10.1f MB" % (
+				benchmark.name, result["seconds"], result["throughput"], result["unit"],
+				result["peak_rss"] / (1024 * 1024)
+			))
+	finally:
+		if not args.workdir:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	regressions = []
+	if args.save_baseline:
+		print("Saving baseline to %r" % (args.baseline))
+		with open(args.baseline, "w") as f:
+			json.dump({"params": params, "results": results}, f, indent="\t", sort_keys=True)
+			f.write("\n")
+	elif os.path.exists(args.baseline):
+		with open(args.baseline, "r") as f:
+			baseline = json.load(f)
+		if baseline["params"] != params:
+			print("Baseline %r was recorded with %r, not comparing" % (args.baseline, baseline["params"]))
+		else:
+			for name, result in results.items():
+				if name in baseline["results"]:
+					regressions += compare(name, result, baseline["results"][name], args.threshold)
+			print("%i regressions against %r" % (len(regressions), args.baseline))
+			for regression in regressions:
+				print("  " + regression)
+
+	if failed or regressions:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
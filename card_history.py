@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+Index of the history of every card across builds. Each tag value and
+localized string of a card is stored once per interval of builds in
+which it did not change, so that the state of a card at any build and
+the changes between two builds can be queried without parsing the
+CardDefs.xml of every build.
+"""
+import hashlib
+import os
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from io import BytesIO
+from lxml import etree as ElementTree
+from hearthstone.enums import GameTag
+from commit_history import BUILDDIR, load_patches
+
+
+DEFAULT_DB = os.path.join(BUILDDIR, "card-history.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS build (
+	build INTEGER PRIMARY KEY, version TEXT, date TEXT, sha1 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS card_history (
+	card_id TEXT NOT NULL, start_build INTEGER NOT NULL, end_build INTEGER
+);
+CREATE TABLE IF NOT EXISTS tag_history (
+	card_id TEXT NOT NULL, tag INTEGER NOT NULL, referenced INTEGER NOT NULL,
+	value INTEGER NOT NULL, start_build INTEGER NOT NULL, end_build INTEGER
+);
+CREATE TABLE IF NOT EXISTS string_history (
+	card_id TEXT NOT NULL, tag INTEGER NOT NULL, locale TEXT NOT NULL,
+	text TEXT NOT NULL, start_build INTEGER NOT NULL, end_build INTEGER
+);
+CREATE INDEX IF NOT EXISTS card_history_card ON card_history (card_id, start_build);
+CREATE INDEX IF NOT EXISTS card_history_end ON card_history (end_build);
+CREATE INDEX IF NOT EXISTS tag_history_card ON tag_history (card_id, start_build);
+CREATE INDEX IF NOT EXISTS tag_history_start ON tag_history (tag, start_build);
+CREATE INDEX IF NOT EXISTS tag_history_end ON tag_history (end_build);
+CREATE INDEX IF NOT EXISTS string_history_card ON string_history (card_id, start_build);
+CREATE INDEX IF NOT EXISTS string_history_start ON string_history (tag, locale, start_build);
+CREATE INDEX IF NOT EXISTS string_history_end ON string_history (end_build);
+"""
+
+# The (table, key columns, value column) of the versioned tables
+HISTORY_TABLES = [
+	("card_history", ("card_id", ), None),
+	("tag_history", ("card_id", "tag", "referenced"), "value"),
+	("string_history", ("card_id", "tag", "locale"), "text"),
+]
+
+
+def parse_carddefs(f):
+	"""
+	Read a processed CardDefs.xml and return a dict of table name ->
+	{key: value} for each of the HISTORY_TABLES.
+	"""
+	cards, tags, strings = {}, {}, {}
+	for event, entity in ElementTree.iterparse(f, tag="Entity"):
+		id = entity.attrib["CardID"]
+		cards[(id, )] = None
+		for e in entity:
+			if e.tag not in ("Tag", "ReferencedTag"):
+				continue
+			tag = int(e.attrib["enumID"])
+			# Localized strings are LocString, unlocalized ones String
+			if e.attrib.get("type") in ("String", "LocString"):
+				if len(e):
+					for locale in e:
+						strings[(id, tag, locale.tag)] = locale.text or ""
+				else:
+					# Unlocalized strings
+					strings[(id, tag, "enUS")] = e.text or ""
+			elif "value" in e.attrib:
+				tags[(id, tag, int(e.tag == "ReferencedTag"))] = int(e.attrib["value"])
+		entity.clear()
+	return {"card_history": cards, "tag_history": tags, "string_history": strings}
+
+
+def parse_tag(value):
+	if value.isdigit():
+		return int(value)
+	try:
+		return int(GameTag[value.upper()])
+	except KeyError:
+		raise ValueError("Unknown tag: %r" % (value))
+
+
+def tag_name(tag):
+	try:
+		return GameTag(tag).name
+	except ValueError:
+		return str(tag)
+
+
+class CardHistory:
+	def __init__(self, path):
+		self.db = sqlite3.connect(path)
+		self.db.executescript(SCHEMA)
+
+	def close(self):
+		self.db.close()
+
+	def latest_build(self):
+		return self.db.execute("SELECT MAX(build) FROM build").fetchone()[0]
+
+	def add_build(self, build, data, version=None, date=None):
+		"""
+		Add \a build, from the contents \a data of its CardDefs.xml.
+		Builds can only be added in increasing order; the latest build
+		is replaced if its CardDefs.xml changed. Return False if the
+		build is already indexed with the same CardDefs.xml.
+		"""
+		sha1 = hashlib.sha1(data).hexdigest()
+		known = self.db.execute("SELECT sha1 FROM build WHERE build = ?", (build, )).fetchone()
+		if known and known[0] == sha1:
+			return False
+		latest = self.latest_build()
+		if latest is not None and build < latest:
+			if known:
+				raise ValueError("Build %i is already indexed and is not the latest build %i" % (build, latest))
+			raise ValueError("Build %i is older than the latest indexed build %i" % (build, latest))
+
+		state = parse_carddefs(BytesIO(data))
+		with self.db:
+			if known:
+				self._remove_latest_build(build)
+			self.db.execute("INSERT INTO build VALUES (?, ?, ?, ?)", (build, version, date, sha1))
+			for table, keys, column in HISTORY_TABLES:
+				self._update_table(table, keys, column, state[table], build)
+		return True
+
+	def _remove_latest_build(self, build):
+		"""
+		Undo the changes of \a build, which must be the latest build.
+		"""
+		for table, keys, column in HISTORY_TABLES:
+			self.db.execute("DELETE FROM %s WHERE start_build = ?" % (table), (build, ))
+			self.db.execute("UPDATE %s SET end_build = NULL WHERE end_build = ?" % (table), (build, ))
+		self.db.execute("DELETE FROM build WHERE build = ?", (build, ))
+
+	def _update_table(self, table, keys, column, new, build):
+		"""
+		Close the open intervals of \a table whose value changed or
+		disappeared in \a build, and open new ones for the new values.
+		"""
+		columns = ", ".join(keys + ((column, ) if column else ()))
+		current = {}
+		for row in self.db.execute("SELECT rowid, %s FROM %s WHERE end_build IS NULL" % (columns, table)):
+			key = row[1:len(keys) + 1]
+			current[key] = (row[0], row[-1] if column else None)
+
+		closed = [
+			(build, rowid) for key, (rowid, value) in current.items()
+			if key not in new or new[key] != value
+		]
+		opened = [
+			key + ((value, ) if column else ()) + (build, ) for key, value in new.items()
+			if key not in current or current[key][1] != value
+		]
+		self.db.executemany("UPDATE %s SET end_build = ? WHERE rowid = ?" % (table), closed)
+		placeholders = ", ".join("?" * (len(keys) + bool(column) + 1))
+		self.db.executemany(
+			"INSERT INTO %s (%s, start_build) VALUES (%s)" % (table, columns, placeholders), opened
+		)
+
+	def card_state(self, card_id, build):
+		"""
+		Return the (tags, referenced tags, strings) of \a card_id as of
+		\a build, or None if it did not exist then.
+		"""
+		where = "card_id = ? AND start_build <= ? AND (end_build IS NULL OR end_build > ?)"
+		args = (card_id, build, build)
+		if not self.db.execute("SELECT 1 FROM card_history WHERE " + where, args).fetchone():
+			return None
+		tags, referenced_tags, strings = {}, {}, {}
+		for tag, referenced, value in self.db.execute(
+			"SELECT tag, referenced, value FROM tag_history WHERE %s ORDER BY tag" % (where), args
+		):
+			(referenced_tags if referenced else tags)[tag] = value
+		for tag, locale, text in self.db.execute(
+			"SELECT tag, locale, text FROM string_history WHERE %s ORDER BY tag, locale" % (where), args
+		):
+			strings.setdefault(tag, {})[locale] = text
+		return tags, referenced_tags, strings
+
+	def changes(self, start, end, tag=None, card_id=None, locale="enUS"):
+		"""
+		Yield the (build, card id, kind, tag, old value, new value) of
+		every change in the builds after \a start up to \a end. Only the
+		strings of \a locale are compared unless it is None.
+		"""
+		for table, keys, column in HISTORY_TABLES:
+			if table == "card_history":
+				if tag is not None:
+					continue
+				kind, tag_expr, value = "'card'", "NULL", "1"
+			elif table == "tag_history":
+				kind = "CASE {a}.referenced WHEN 1 THEN 'referenced_tag' ELSE 'tag' END"
+				tag_expr, value = "{a}.tag", "{a}.value"
+			else:
+				kind, tag_expr, value = "'string'", "{a}.tag", "{a}.text"
+
+			filters, args = [], []
+			if tag is not None:
+				filters.append("{a}.tag = ?")
+				args.append(tag)
+			if card_id is not None:
+				filters.append("{a}.card_id = ?")
+				args.append(card_id)
+			if table == "string_history" and locale:
+				filters.append("{a}.locale = ?")
+				args.append(locale)
+			join = " AND ".join("o.%s = n.%s" % (key, key) for key in keys)
+
+			def expr(template, a):
+				return template.format(a=a)
+
+			# New values, along with the value they replaced if any
+			where = ["n.start_build > ?", "n.start_build <= ?"] + [expr(f, "n") for f in filters]
+			yield from self.db.execute(
+				"SELECT n.start_build, n.card_id, %s, %s, CASE WHEN o.rowid IS NULL THEN NULL ELSE %s END, %s "
+				"FROM %s n LEFT JOIN %s o ON %s AND o.end_build = n.start_build WHERE %s" % (
+					expr(kind, "n"), expr(tag_expr, "n"), expr(value, "o"), expr(value, "n"),
+					table, table, join, " AND ".join(where)
+				), [start, end] + args
+			)
+
+			# Values which disappeared without being replaced
+			where = ["o.end_build > ?", "o.end_build <= ?", "n.rowid IS NULL"] + [expr(f, "o") for f in filters]
+			yield from self.db.execute(
+				"SELECT o.end_build, o.card_id, %s, %s, %s, NULL "
+				"FROM %s o LEFT JOIN %s n ON %s AND n.start_build = o.end_build WHERE %s" % (
+					expr(kind, "o"), expr(tag_expr, "o"), expr(value, "o"),
+					table, table, join, " AND ".join(where)
+				), [start, end] + args
+			)
+
+
+def format_value(kind, value):
+	if value is None:
+		return "(none)"
+	if kind == "card":
+		return "exists"
+	return repr(value)
+
+
+def main():
+	p = ArgumentParser()
+	p.add_argument("--db", type=str, default=DEFAULT_DB, help="Path to the history database")
+	subparsers = p.add_subparsers(dest="command")
+
+	add = subparsers.add_parser("add", help="Add a build from its processed CardDefs.xml")
+	add.add_argument("build", type=int)
+	add.add_argument("carddefs", type=str)
+
+	import_git = subparsers.add_parser(
+		"import", help="Add every build of the patches table tagged in an hsdata repository"
+	)
+	import_git.add_argument("repo", type=str)
+	import_git.add_argument("--path", type=str, default="CardDefs.xml", help="Path of the CardDefs in the repository")
+
+	show = subparsers.add_parser("show", help="State of a card at a build")
+	show.add_argument("card_id", type=str)
+	show.add_argument("--build", type=int, help="Defaults to the latest build")
+
+	changes = subparsers.add_parser("changes", help="Changes between two builds")
+	changes.add_argument("--from", dest="start", type=int, default=0, help="Exclusive")
+	changes.add_argument("--to", dest="end", type=int, help="Inclusive, defaults to the latest build")
+	changes.add_argument("--tag", type=str, help="Only this tag, by name or id")
+	changes.add_argument("--card", type=str, help="Only this card")
+	changes.add_argument(
+		"--locale", type=str, default="enUS",
+		help="Locale of the string changes, or 'all'"
+	)
+
+	args = p.parse_args()
+	if not args.command:
+		p.error("No command given")
+
+	history = CardHistory(args.db)
+	patches = {build: (version, date) for build, version, date in load_patches()}
+
+	if args.command == "add":
+		with open(args.carddefs, "rb") as f:
+			data = f.read()
+		version, date = patches.get(args.build, (None, None))
+		try:
+			if history.add_build(args.build, data, version, date):
+				print("Added build %i" % (args.build))
+			else:
+				print("Build %i is already indexed" % (args.build))
+		except ValueError as e:
+			# Not fatal, the index can be rebuilt with the import command
+			sys.stderr.write("[WARN] Not adding build %i: %s\n" % (args.build, e))
+
+	elif args.command == "import":
+		from smartdiff_cardxml import GitBlobReader, git_tags
+
+		tags = set(git_tags(args.repo).values())
+		latest = history.latest_build() or 0
+		reader = GitBlobReader(args.repo)
+		try:
+			for build, (version, date) in sorted(patches.items()):
+				if build <= latest or str(build) not in tags:
+					continue
+				sha, data = reader.read("%i:%s" % (build, args.path))
+				history.add_build(build, data, version, date)
+				print("Added build %i" % (build))
+		finally:
+			reader.close()
+
+	elif args.command == "show":
+		build = args.build or history.latest_build()
+		state = history.card_state(args.card_id, build)
+		if state is None:
+			print("%s does not exist at build %s" % (args.card_id, build))
+			sys.exit(1)
+		tags, referenced_tags, strings = state
+		print("%s at build %s:" % (args.card_id, build))
+		for tag, value in tags.items():
+			print("  %s = %r" % (tag_name(tag), value))
+		for tag, value in referenced_tags.items():
+			print("  %s (referenced) = %r" % (tag_name(tag), value))
+		for tag, texts in strings.items():
+			for locale, text in texts.items():
+				print("  %s [%s] = %r" % (tag_name(tag), locale, text))
+
+	elif args.command == "changes":
+		end = args.end or history.latest_build()
+		tag = parse_tag(args.tag) if args.tag else None
+		locale = None if args.locale == "all" else args.locale
+		for build, card_id, kind, tag, before, after in sorted(
+			history.changes(args.start, end, tag, args.card, locale),
+			key=lambda change: (change[0], change[1], change[2], change[3] or 0)
+		):
+			name = "" if kind == "card" else " %s%s" % (tag_name(tag), " (referenced)" if kind == "referenced_tag" else "")
+			print("%i %s%s: %s -> %s" % (
+				build, card_id, name, format_value(kind, before), format_value(kind, after)
+			))
+
+	history.close()
+
+
+if __name__ == "__main__":
+	main()
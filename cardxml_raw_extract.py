@@ -1,30 +1,71 @@
 #!/usr/bin/env python
+import mmap
 import re
 import sys
 from hearthstone.enums import Locale
 
 
-def find_substring(s, search_space):
-	return s in search_space or s.lower() in search_space
+CARDDEFS_START = b"<CardDefs>"
+CARDDEFS_END = b"</CardDefs>"
 
 
-def find_locale(data, index):
+def _compile_locale_re():
+	names = {}
 	for loc in Locale.__members__:
 		if loc == "UNKNOWN":
 			continue
+		names[loc] = loc
+		names[loc.lower()] = loc
+
+	# Lookahead so that overlapping names are all reported
+	alternation = "|".join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+	return re.compile("(?=(%s))" % (alternation)), names
 
-		search_space = data[index-100:index]
-		if find_substring(loc, search_space):
-			return loc
 
-	raise RuntimeError("Could not find locale")
+LOCALE_RE, LOCALE_NAMES = _compile_locale_re()
 
 
-def pluck_carddefs_xml(data):
-	end_match = re.search(r"</CardDefs>", data)
-	if not end_match:
-		raise RuntimeError("Could not find end of XML block")
-	return data[:end_match.end()]
+def find_locale(data, index):
+	"""
+	Return the locale whose name is closest before \a index in \a data,
+	looking at most 100 characters back.
+	"""
+	matches = [
+		(match.start() + len(match.group(1)), LOCALE_NAMES[match.group(1)])
+		for match in LOCALE_RE.finditer(data, max(index - 100, 0), index)
+	]
+	if not matches:
+		raise RuntimeError("Could not find locale")
+
+	end = max(end for end, loc in matches)
+	closest = sorted(set(loc for e, loc in matches if e == end))
+	if len(closest) > 1:
+		raise RuntimeError("Ambiguous locale at %i: %s" % (index, ", ".join(closest)))
+
+	others = sorted(set(loc for e, loc in matches) - set(closest))
+	if others:
+		sys.stderr.write("[WARN] Locales %s also found before %r at %i\n" % (
+			", ".join(others), closest[0], index
+		))
+
+	return closest[0]
+
+
+def find_carddefs(data):
+	"""
+	Yield the (start, end) offsets of every CardDefs block in \a data,
+	scanning the bytes once from start to end.
+	"""
+	end = 0
+	start = data.find(CARDDEFS_START)
+	while start != -1:
+		if end <= start:
+			end = data.find(CARDDEFS_END, start)
+			if end == -1:
+				raise RuntimeError("Could not find end of XML block")
+			end += len(CARDDEFS_END)
+		yield start, end
+		start = data.find(CARDDEFS_START, start + len(CARDDEFS_START))
 
 
 def write_file(filename, data):
@@ -34,13 +75,13 @@ def write_file(filename, data):
 
 
 def parse_bundle(f):
-	data = f.read()
-	decoded = data.decode("utf-8", "ignore")
-	indices = [match.start() for match in re.finditer(r"<CardDefs>", decoded)]
-	for index in indices:
-		locale = find_locale(decoded, index)
-		xml = pluck_carddefs_xml(decoded[index:])
-		write_file(locale + ".xml", xml)
+	with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+		for start, end in find_carddefs(data):
+			# Enough bytes to decode the 100 characters preceding the block
+			context = data[max(start - 400, 0):start].decode("utf-8", "ignore")
+			locale = find_locale(context, len(context))
+			xml = data[start:end].decode("utf-8", "ignore")
+			write_file(locale + ".xml", xml)
 
 
 def main():
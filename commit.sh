@@ -3,6 +3,7 @@ BASEDIR="$(readlink -f $(dirname $0))"
 BUILDDIR="$BASEDIR/build"
 GH="git@github.com:HearthSim"
 GL="git@gitlab.com:HearthSim"
+SYNC_BIN="$BASEDIR/sync_tree.py"
 
 
 export GIT_AUTHOR_NAME="HearthSim Bot"
@@ -84,28 +85,6 @@ declare -A directories=(
 )
 
 
-function _init-repo() {
-	PROJECT="$1"
-	REPO="$BASEDIR/$PROJECT.git"
-	GIT="git -C $REPO"
-	README="$BASEDIR/res/README-$PROJECT.md"
-
-	# Initial commit date
-	export GIT_AUTHOR_DATE="2013-03-22 12:00:00 +0000"
-	export GIT_COMMITTER_DATE="$GIT_AUTHOR_DATE"
-
-	echo "Initializing $PROJECT"
-	rm -rf "$REPO"
-	git init "$REPO"
-	cp "$README" "$REPO/README.md"
-	$GIT remote add origin "$GL/$PROJECT.git"
-	$GIT remote set-url --add origin "$GH/$PROJECT.git"
-	$GIT add README.md
-	$GIT commit -m "Initial commit"
-	$GIT config branch.master.remote origin
-	$GIT config branch.master.merge refs/heads/master
-}
-
 function _commit() {
 	PROJECT=$1
 	BUILD=$2
@@ -139,35 +118,31 @@ function _update-hsdata() {
 	playerrors="$BUILDDIR/extracted/$BUILD/Data/PlayErrors.xml"
 	[[ -s "$manifest" ]] && cp "$manifest" "$REPO"
 	[[ -s "$playerrors" ]] && cp "$playerrors" "$REPO"
-	rm -rf "$REPO/DBF" "$REPO/Strings"
-	cp -rf "$dir"/* "$REPO"
+	# Only writes the changed files, deletes what's gone from DBF and Strings
+	"$SYNC_BIN" "$dir" "$REPO" --delete DBF Strings
 }
 
 function _update-hscode() {
-	rm -rf "$REPO"/*.cs "$REPO"/**/*.cs
-	cp -rf "$dir"/* "$REPO"
+	"$SYNC_BIN" "$dir" "$REPO" --delete "*.cs" "*/*.cs"
 }
 
 function _update-hsproto() {
-	rm -rf "$REPO/bnet" "$REPO/pegasus"
-	cp -rf "$dir"/* "$REPO"
+	"$SYNC_BIN" "$dir" "$REPO" --delete bnet pegasus
 }
 
 function _commit-all() {
-	_init-repo "$1"
-	for BUILD in "${!patches[@]}"; do
-		_commit "$1" "$BUILD"
-	done
+	# Rebuilds the whole history through git fast-import
+	"$BASEDIR/commit_history.py" "$1"
 }
 
 
 if [[ ! -z "$1" ]]; then
 	_commit hsdata $1
 	_commit hscode $1
-	# _commit hsproto $1
+	_commit hsproto $1
 	exit
 fi
 
 _commit-all hsdata
 _commit-all hscode
-# _commit-all hsproto
+_commit-all hsproto
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+Rebuilds the full history of the hsdata/hscode/hsproto repositories
+through a single `git fast-import` stream, with the builds and dates
+of the patches table in commit.sh. Only the files whose content changed
+between builds are written to the repository.
+"""
+import calendar
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+from argparse import ArgumentParser
+
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+BUILDDIR = os.path.join(BASEDIR, "build")
+COMMIT_SH = os.path.join(BASEDIR, "commit.sh")
+GH = "git@github.com:HearthSim"
+GL = "git@gitlab.com:HearthSim"
+
+DIRECTORIES = {
+	"hscode": os.path.join(BUILDDIR, "decompiled"),
+	"hsdata": os.path.join(BUILDDIR, "processed"),
+	"hsproto": os.path.join(BUILDDIR, "protos"),
+}
+
+INITIAL_DATE = "2013-03-22"
+
+# Commented out builds do not match
+PATCH_RE = re.compile(r'^\s*\["(\d+)"\]="(\S+) (\S+)"', re.MULTILINE)
+
+
+def load_patches(path=COMMIT_SH):
+	"""
+	Return the sorted (build, version, date) of the patches table in \a path.
+	"""
+	with open(path, "r") as f:
+		data = f.read()
+	return sorted((int(build), version, date) for build, version, date in PATCH_RE.findall(data))
+
+
+def timestamp(date):
+	"""
+	Return the git date for noon UTC on \a date, as commit.sh uses.
+	"""
+	t = calendar.timegm(time.strptime(date + " 12:00:00", "%Y-%m-%d %H:%M:%S"))
+	return "%i +0000" % (t)
+
+
+# The escapes of git's C-style quoting, other control and non-ASCII
+# bytes are written in octal
+C_ESCAPES = {
+	0x07: "\\a", 0x08: "\\b", 0x09: "\\t", 0x0a: "\\n", 0x0b: "\\v",
+	0x0c: "\\f", 0x0d: "\\r", 0x22: '\\"', 0x5c: "\\\\",
+}
+
+
+def _quote_path(path):
+	"""
+	Quote \a path the way git does if fast-import can't read it as is,
+	when it starts with a quote or contains a newline.
+	"""
+	if not path.startswith('"') and "\n" not in path:
+		return path
+	ret = []
+	for byte in path.encode("utf-8"):
+		if byte in C_ESCAPES:
+			ret.append(C_ESCAPES[byte])
+		elif byte < 0x20 or byte >= 0x7f:
+			ret.append("\\%03o" % (byte))
+		else:
+			ret.append(chr(byte))
+	return '"%s"' % ("".join(ret))
+
+
+def _match(path, pattern):
+	"""
+	Shell-style match where * does not match across directories.
+	"""
+	parts, pattern_parts = path.split("/"), pattern.split("/")
+	return len(parts) == len(pattern_parts) and all(
+		fnmatch.fnmatchcase(part, pattern_part) for part, pattern_part in zip(parts, pattern_parts)
+	)
+
+
+class HashCache:
+	"""
+	SHA-1 of files, only recomputed when their size or mtime changed.
+	"""
+	def __init__(self, path=None):
+		self.path = path
+		self.entries = {}
+		if path and os.path.exists(path):
+			with open(path, "r") as f:
+				self.entries = json.load(f)
+
+	def hash(self, path):
+		st = os.stat(path)
+		known = self.entries.get(path)
+		if known and known[:2] == [st.st_size, st.st_mtime_ns]:
+			return known[2]
+		sha1 = hashlib.sha1()
+		with open(path, "rb") as f:
+			for chunk in iter(lambda: f.read(1024 * 1024), b""):
+				sha1.update(chunk)
+		self.entries[path] = [st.st_size, st.st_mtime_ns, sha1.hexdigest()]
+		return sha1.hexdigest()
+
+	def save(self):
+		if self.path:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			with open(self.path + ".tmp", "w") as f:
+				json.dump(self.entries, f)
+			os.replace(self.path + ".tmp", self.path)
+
+
+class HistoryBuilder:
+	"""
+	Writes the commits of a project to a `git fast-import` process.
+	The tree of the repository is kept in memory as a dict of
+	path -> (mode, digest), and a blob is only sent the first time its
+	content is seen.
+	"""
+	def __init__(self, project, repo, hash_cache):
+		self.project = project
+		self.repo = repo
+		self.hash_cache = hash_cache
+		self.name = os.environ.get("GIT_AUTHOR_NAME", "HearthSim Bot")
+		self.email = os.environ.get("GIT_AUTHOR_EMAIL", "commits@hearthsim.info")
+		self.tree = {}
+		self.head = None
+		self.marks = {}
+		self.next_mark = 1
+		# digest -> path or bytes of the blobs not sent yet
+		self.sources = {}
+		self.blobs = 0
+		self.process = None
+
+	def _write(self, data):
+		self.process.stdin.write(data)
+
+	def _new_mark(self):
+		mark = self.next_mark
+		self.next_mark += 1
+		return mark
+
+	def add_file(self, path, source):
+		"""
+		Set \a path in the tree to the file at \a source.
+		"""
+		digest = self.hash_cache.hash(source)
+		mode = "100755" if os.access(source, os.X_OK) else "100644"
+		self.tree[path] = (mode, digest)
+		if digest not in self.marks:
+			self.sources[digest] = source
+
+	def add_data(self, path, data):
+		digest = hashlib.sha1(data).hexdigest()
+		self.tree[path] = ("100644", digest)
+		if digest not in self.marks:
+			self.sources[digest] = data
+
+	def remove(self, path):
+		"""
+		Remove the file or directory at \a path from the tree.
+		"""
+		prefix = path + "/"
+		for p in [p for p in self.tree if p == path or p.startswith(prefix)]:
+			del self.tree[p]
+
+	def remove_glob(self, pattern):
+		for p in [p for p in self.tree if _match(p, pattern)]:
+			del self.tree[p]
+
+	def copy_dir(self, dirname):
+		"""
+		Same as `cp -rf dirname/* REPO`.
+		"""
+		for entry in sorted(os.listdir(dirname)):
+			if entry.startswith("."):
+				continue
+			path = os.path.join(dirname, entry)
+			if not os.path.isdir(path):
+				self.add_file(entry, path)
+				continue
+			# cp replaces files by directories and merges directories
+			self.tree.pop(entry, None)
+			for root, dirs, files in os.walk(path):
+				dirs.sort()
+				for filename in sorted(files):
+					source = os.path.join(root, filename)
+					self.add_file(os.path.relpath(source, dirname).replace(os.sep, "/"), source)
+
+	def blob(self, digest):
+		if digest in self.marks:
+			return self.marks[digest]
+
+		mark = self.marks[digest] = self._new_mark()
+		source = self.sources.pop(digest)
+		self._write(b"blob\nmark :%i\n" % (mark))
+		if isinstance(source, bytes):
+			self._write(b"data %i\n" % (len(source)) + source + b"\n")
+		else:
+			self._write(b"data %i\n" % (os.path.getsize(source)))
+			with open(source, "rb") as f:
+				shutil.copyfileobj(f, self.process.stdin)
+			self._write(b"\n")
+		self.blobs += 1
+		return mark
+
+	def commit(self, previous_tree, message, date):
+		"""
+		Commit the changes from \a previous_tree to the current tree.
+		Return False if there was nothing to commit.
+		"""
+		changes = []
+		for path in sorted(previous_tree.keys() - self.tree.keys()):
+			changes.append(("D %s\n" % (_quote_path(path))).encode("utf-8"))
+		for path, (mode, digest) in sorted(self.tree.items()):
+			if previous_tree.get(path) != (mode, digest):
+				mark = self.blob(digest)
+				changes.append(("M %s :%i %s\n" % (mode, mark, _quote_path(path))).encode("utf-8"))
+		if not changes:
+			return False
+
+		message = (message + "\n").encode("utf-8")
+		ident = ("%s <%s> %s" % (self.name, self.email, timestamp(date))).encode("utf-8")
+		mark = self._new_mark()
+		self._write(b"commit refs/heads/master\nmark :%i\n" % (mark))
+		self._write(b"author " + ident + b"\ncommitter " + ident + b"\n")
+		self._write(b"data %i\n" % (len(message)) + message)
+		if self.head:
+			self._write(b"from :%i\n" % (self.head))
+		self._write(b"".join(changes) + b"\n")
+		self.head = mark
+		return True
+
+	def tag(self, name, message, date):
+		message = (message + "\n").encode("utf-8")
+		ident = ("%s <%s> %s" % (self.name, self.email, timestamp(date))).encode("utf-8")
+		self._write(("tag %s\nfrom :%i\n" % (name, self.head)).encode("utf-8"))
+		self._write(b"tagger " + ident + b"\n")
+		self._write(b"data %i\n" % (len(message)) + message + b"\n")
+
+	def update(self, build, dirname):
+		"""
+		Same as the _update-<project> function of commit.sh.
+		"""
+		if self.project == "hsdata":
+			extracted = os.path.join(BUILDDIR, "extracted", str(build))
+			for path in ("manifest-cards.csv", "Data/PlayErrors.xml"):
+				source = os.path.join(extracted, path)
+				if os.path.exists(source) and os.path.getsize(source):
+					self.add_file(os.path.basename(path), source)
+			self.remove("DBF")
+			self.remove("Strings")
+		elif self.project == "hscode":
+			# `rm -rf "$REPO"/*.cs "$REPO"/**/*.cs` without globstar
+			self.remove_glob("*.cs")
+			self.remove_glob("*/*.cs")
+		elif self.project == "hsproto":
+			self.remove("bnet")
+			self.remove("pegasus")
+		self.copy_dir(dirname)
+
+	def run(self, patches):
+		print("Initializing %s" % (self.project))
+		if os.path.exists(self.repo):
+			shutil.rmtree(self.repo)
+		subprocess.check_call(["git", "init", "--quiet", self.repo])
+		subprocess.check_call(["git", "-C", self.repo, "symbolic-ref", "HEAD", "refs/heads/master"])
+
+		self.process = subprocess.Popen(
+			["git", "-C", self.repo, "fast-import", "--quiet"], stdin=subprocess.PIPE
+		)
+		try:
+			with open(os.path.join(BASEDIR, "res", "README-%s.md" % (self.project)), "r") as f:
+				readme = f.read()
+			self.add_data("README.md", readme.encode("utf-8"))
+			self.commit({}, "Initial commit", INITIAL_DATE)
+
+			for build, version, date in patches:
+				dirname = os.path.join(DIRECTORIES[self.project], str(build))
+				if not os.path.isdir(dirname):
+					continue
+				patch = "%s.%i" % (version, build)
+				print("Committing %s for %s" % (self.project, patch))
+
+				previous_tree = dict(self.tree)
+				readme = re.sub(r"Version: .*", "Version: " + patch, readme)
+				self.add_data("README.md", readme.encode("utf-8"))
+				self.update(build, dirname)
+				# The tag goes on the previous commit if nothing changed
+				self.commit(previous_tree, "Update to patch %s" % (patch), date)
+				self.tag(str(build), "Patch %s" % (patch), date)
+		finally:
+			self.process.stdin.close()
+			if self.process.wait() != 0:
+				raise RuntimeError("git fast-import failed for %r" % (self.repo))
+			self.hash_cache.save()
+
+		git = ["git", "-C", self.repo]
+		subprocess.check_call(git + ["remote", "add", "origin", "%s/%s.git" % (GL, self.project)])
+		subprocess.check_call(git + ["remote", "set-url", "--add", "origin", "%s/%s.git" % (GH, self.project)])
+		subprocess.check_call(git + ["config", "branch.master.remote", "origin"])
+		subprocess.check_call(git + ["config", "branch.master.merge", "refs/heads/master"])
+		subprocess.check_call(git + ["reset", "--hard", "--quiet"])
+		print("Wrote %i blobs to %s" % (self.blobs, self.repo))
+
+
+def main():
+	p = ArgumentParser()
+	p.add_argument(
+		"projects", nargs="*", default=["hsdata", "hscode"],
+		help="Repositories to rebuild, among %s" % (", ".join(sorted(DIRECTORIES)))
+	)
+	p.add_argument(
+		"--hash-cache", type=str, default=os.path.join(BUILDDIR, "commit-history.cache"),
+		help="Where to keep the hashes of the build files between runs"
+	)
+	p.add_argument("--no-hash-cache", action="store_true")
+	args = p.parse_args()
+	for project in args.projects:
+		if project not in DIRECTORIES:
+			p.error("Unknown project: %r" % (project))
+
+	patches = load_patches()
+	hash_cache = HashCache(None if args.no_hash_cache else args.hash_cache)
+	for project in args.projects:
+		repo = os.path.join(BASEDIR, "%s.git" % (project))
+		HistoryBuilder(project, repo, hash_cache).run(patches)
+
+
+if __name__ == "__main__":
+	main()
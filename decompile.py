@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Decompiles the managed assemblies of a build with decompile.exe.
+The IL of the types of every code file is hashed first, and only the
+files whose hash is not in the cache are decompiled, sharded across
+several decompile.exe processes. The other files are copied from the
+cache, which is shared by all the builds.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+BUILDDIR = os.path.join(BASEDIR, "build")
+DECOMPILER = os.path.join(BASEDIR, "decompiler", "build", "decompile.exe")
+MONO = "mono"
+
+# Loading an assembly is expensive, so shards are never made smaller
+MIN_SHARD_SIZE = 50
+
+
+def file_sha1(path):
+	sha1 = hashlib.sha1()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+
+def copy_file(src, dst):
+	os.makedirs(os.path.dirname(dst), exist_ok=True)
+	shutil.copyfile(src, dst)
+
+
+class DecompileCache:
+	"""
+	Decompiled code files, keyed by the decompiler, the assembly name,
+	the path of the file and the hash of its IL.
+	"""
+	def __init__(self, path, decompiler_hash):
+		self.path = path
+		self.decompiler_hash = decompiler_hash
+
+	def key(self, assembly, filename, il_hash):
+		data = "\0".join((self.decompiler_hash, assembly, filename, il_hash))
+		return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+	def get(self, key):
+		path = os.path.join(self.path, key[:2], key[2:])
+		if os.path.exists(path):
+			return path
+
+	def put(self, key, source):
+		path = os.path.join(self.path, key[:2], key[2:])
+		copy_file(source, path + ".tmp")
+		os.replace(path + ".tmp", path)
+
+
+class Decompiler:
+	def __init__(self, cache, jobs):
+		self.cache = cache
+		self.jobs = jobs
+		self.workdir = None
+
+	def _run(self, *args):
+		return subprocess.check_output([MONO, DECOMPILER] + list(args)).decode("utf-8")
+
+	def hash_files(self, dll):
+		"""
+		Return a dict of the code files of \a dll to the hash of their IL.
+		"""
+		ret = {}
+		for line in self._run("--hash", dll).splitlines():
+			if "\t" in line:
+				il_hash, filename = line.split("\t", 1)
+				ret[filename] = il_hash
+		return ret
+
+	def decompile_shard(self, dll, outdir, filenames):
+		os.makedirs(outdir)
+		list_path = outdir + ".files"
+		with open(list_path, "w") as f:
+			f.write("".join(filename + "\n" for filename in filenames))
+		self._run(dll, outdir, list_path)
+		for filename in filenames:
+			if not os.path.exists(os.path.join(outdir, filename)):
+				raise RuntimeError("%s was not decompiled from %s" % (filename, dll))
+
+	def shard(self, filenames):
+		count = max(1, min(self.jobs, len(filenames) // MIN_SHARD_SIZE))
+		return [filenames[i::count] for i in range(count)]
+
+	def decompile(self, dlls, outdir):
+		with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+			hashes = dict(zip(dlls, executor.map(self.hash_files, dlls)))
+
+			shards = {}
+			futures = []
+			for n, dll in enumerate(dlls):
+				assembly = os.path.basename(dll)
+				missing = sorted(
+					filename for filename, il_hash in hashes[dll].items()
+					if not self.cache.get(self.cache.key(assembly, filename, il_hash))
+				)
+				print("%s: %i code files, %i to decompile" % (assembly, len(hashes[dll]), len(missing)))
+				# The first shard also writes the resources and AssemblyInfo
+				shards[dll] = []
+				for i, filenames in enumerate(self.shard(missing)):
+					shard_dir = os.path.join(self.workdir, "%i-%i" % (n, i))
+					shards[dll].append((shard_dir, filenames))
+					futures.append(executor.submit(self.decompile_shard, dll, shard_dir, filenames))
+
+			for future in futures:
+				future.result()
+
+		for dll in dlls:
+			assembly = os.path.basename(dll)
+			first_shard = shards[dll][0][0]
+			code_files = set(hashes[dll])
+			for root, dirs, files in os.walk(first_shard):
+				for filename in files:
+					path = os.path.relpath(os.path.join(root, filename), first_shard).replace(os.sep, "/")
+					if path not in code_files:
+						copy_file(os.path.join(root, filename), os.path.join(outdir, path))
+
+			for shard_dir, filenames in shards[dll]:
+				for filename in filenames:
+					key = self.cache.key(assembly, filename, hashes[dll][filename])
+					self.cache.put(key, os.path.join(shard_dir, filename))
+
+			for filename, il_hash in hashes[dll].items():
+				cached = self.cache.get(self.cache.key(assembly, filename, il_hash))
+				copy_file(cached, os.path.join(outdir, filename))
+
+	def run(self, dlls, outdir):
+		"""
+		Decompile \a dlls into \a outdir, replacing its previous content
+		once everything succeeded.
+		"""
+		staging = outdir + ".tmp"
+		if os.path.exists(staging):
+			shutil.rmtree(staging)
+		os.makedirs(staging)
+		self.workdir = tempfile.mkdtemp(prefix="decompile-")
+		try:
+			self.decompile(dlls, staging)
+		finally:
+			shutil.rmtree(self.workdir)
+
+		if os.path.exists(outdir):
+			shutil.rmtree(outdir)
+		os.rename(staging, outdir)
+
+
+def main():
+	p = ArgumentParser()
+	p.add_argument("assemblies", nargs="+", metavar="DLL")
+	p.add_argument("outdir")
+	p.add_argument(
+		"-j", "--jobs", type=int, default=min(4, os.cpu_count()),
+		help="Maximum number of decompile.exe processes to run concurrently"
+	)
+	p.add_argument(
+		"--cache-dir", type=str, default=os.path.join(BUILDDIR, "decompile-cache"),
+		help="Where to keep the decompiled code files between builds"
+	)
+	args = p.parse_args()
+
+	dlls = []
+	for dll in args.assemblies:
+		if os.path.exists(dll):
+			dlls.append(dll)
+		else:
+			print("Skipping missing assembly %r" % (dll))
+
+	cache = DecompileCache(args.cache_dir, file_sha1(DECOMPILER))
+	Decompiler(cache, args.jobs).run(dlls, args.outdir)
+
+
+if __name__ == "__main__":
+	main()
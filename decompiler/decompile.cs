@@ -14,6 +14,8 @@ using System.Collections.ObjectModel;
 using System.IO;
 using System.Linq;
 using System.Resources;
+using System.Security.Cryptography;
+using System.Text;
 using System.Text.RegularExpressions;
 using System.Threading.Tasks;
 using System.Xml;
@@ -23,27 +25,413 @@ static class Decompiler
 {
 	static int Main(string[] args)
 	{
-		if (args.Length != 2)
+		if (args.Length == 2 && args[0] == "--hash")
 		{
-			Console.WriteLine("usage: decompiler [dll] [output path]");
+			PrintCodeFileHashes(args[1]);
+			return 0;
+		}
+		if (args.Length == 2 && args[0] == "--protos")
+		{
+			PrintProtos(args[1]);
+			return 0;
+		}
+		if (args.Length != 2 && args.Length != 3)
+		{
+			Console.WriteLine("usage: decompiler [dll] [output path] [code file list]");
+			Console.WriteLine("       decompiler --hash [dll]");
+			Console.WriteLine("       decompiler --protos [dll]");
 			return 2;
 		}
 
+		var assembly = OpenAssembly(args[0]);
+		var root = new AssemblyTreeNode(assembly);
+		var options = CreateOptions();
+		options.SaveAsProjectDirectory = args[1];
+		if (args.Length == 3)
+		{
+			// Only decompile the code files listed, one per line
+			var lines = File.ReadAllLines(args[2]).Where(line => line.Length > 0);
+			options.CodeFiles = new HashSet<string>(lines, StringComparer.OrdinalIgnoreCase);
+		}
+		root.Decompile(new CSharpLanguage(), new PlainTextOutput(), options);
+		return 0;
+	}
+
+	static LoadedAssembly OpenAssembly(string path)
+	{
 		var assemblies = new AssemblyList("global");
-		var assembly = assemblies.OpenAssembly(args[0]);
+		var assembly = assemblies.OpenAssembly(path);
 		assembly.WaitUntilLoaded();
-		var root = new AssemblyTreeNode(assembly);
-		root.Decompile(new CSharpLanguage(), new PlainTextOutput(), new DecompilationOptions
+		return assembly;
+	}
+
+	static DecompilationOptions CreateOptions()
+	{
+		return new DecompilationOptions
 		{
-			SaveAsProjectDirectory = args[1],
 			FullDecompilation = true,
 			DecompilerSettings = new DecompilerSettings
 			{
 				YieldReturn = false
 			}
-		});
-		return 0;
+		};
+	}
+
+	/// <summary>
+	/// Prints the SHA-1 of the IL of the types of each code file, followed by
+	/// a tab and the path of the file. The hash also covers the enums that the
+	/// types use, including the ones of referenced assemblies such as the
+	/// firstpass, as their constants are decompiled by name.
+	/// </summary>
+	static void PrintCodeFileHashes(string path)
+	{
+		var module = OpenAssembly(path).ModuleDefinition;
+		var files = new CSharpLanguage().GetCodeFilesInProject(module, CreateOptions());
+		foreach (var file in files)
+		{
+			var writer = new StringWriter();
+			var enums = new HashSet<TypeDefinition>();
+			foreach (TypeDefinition type in file)
+				WriteTypeIL(writer, type, enums);
+			foreach (TypeDefinition type in enums.OrderBy(t => t.Module.Name + " " + t.FullName, StringComparer.Ordinal))
+			{
+				writer.WriteLine("enum {0} {1}", type.Module.Name, type.FullName);
+				foreach (FieldDefinition field in type.Fields)
+					writer.WriteLine("{0} = {1}", field.Name, field.Constant);
+			}
+			using (var sha1 = SHA1.Create())
+			{
+				byte[] hash = sha1.ComputeHash(Encoding.UTF8.GetBytes(writer.ToString()));
+				string hex = BitConverter.ToString(hash).Replace("-", "").ToLowerInvariant();
+				Console.WriteLine("{0}\t{1}", hex, file.Key.Replace(Path.DirectorySeparatorChar, '/'));
+			}
+		}
+	}
+
+	static void AddEnumReference(TypeReference type, HashSet<TypeDefinition> enums)
+	{
+		if (type == null)
+			return;
+		// References to types of the same module are read as definitions, the
+		// others are resolved from the assemblies next to the decompiled one
+		var element = type.GetElementType();
+		var definition = element as TypeDefinition;
+		if (definition == null && !(element is GenericParameter))
+		{
+			try
+			{
+				definition = element.Resolve();
+			}
+			catch (AssemblyResolutionException)
+			{
+			}
+		}
+		if (definition != null && definition.IsEnum)
+			enums.Add(definition);
+	}
+
+	static void WriteAttributesIL(TextWriter writer, ICustomAttributeProvider provider)
+	{
+		foreach (CustomAttribute attribute in provider.CustomAttributes)
+			writer.WriteLine("[{0} {1}]", attribute.AttributeType.FullName, BitConverter.ToString(attribute.GetBlob()));
+	}
+
+	static void WriteTypeIL(TextWriter writer, TypeDefinition type, HashSet<TypeDefinition> enums)
+	{
+		writer.WriteLine("type {0} {1} : {2}", type.FullName, type.Attributes, type.BaseType != null ? type.BaseType.FullName : "");
+		foreach (GenericParameter parameter in type.GenericParameters)
+			writer.WriteLine("generic {0} {1}", parameter.Name, parameter.Attributes);
+		foreach (TypeReference iface in type.Interfaces)
+			writer.WriteLine("implements {0}", iface.FullName);
+		WriteAttributesIL(writer, type);
+
+		foreach (FieldDefinition field in type.Fields)
+		{
+			writer.WriteLine("field {0} {1} {2} = {3} {4}", field.Attributes, field.FieldType.FullName, field.Name,
+				field.HasConstant ? field.Constant : "", BitConverter.ToString(field.InitialValue ?? new byte[0]));
+			WriteAttributesIL(writer, field);
+			AddEnumReference(field.FieldType, enums);
+		}
+
+		foreach (PropertyDefinition property in type.Properties)
+		{
+			writer.WriteLine("property {0} {1} {2}", property.Attributes, property.PropertyType.FullName, property.Name);
+			WriteAttributesIL(writer, property);
+		}
+
+		foreach (EventDefinition ev in type.Events)
+		{
+			writer.WriteLine("event {0} {1} {2}", ev.Attributes, ev.EventType.FullName, ev.Name);
+			WriteAttributesIL(writer, ev);
+		}
+
+		foreach (MethodDefinition method in type.Methods)
+		{
+			writer.WriteLine("method {0} {1} {2} {3}", method.Attributes, method.ImplAttributes, method.SemanticsAttributes, method.FullName);
+			WriteAttributesIL(writer, method);
+			AddEnumReference(method.ReturnType, enums);
+			foreach (ParameterDefinition parameter in method.Parameters)
+			{
+				writer.WriteLine("param {0} {1} = {2}", parameter.Attributes, parameter.Name, parameter.HasConstant ? parameter.Constant : "");
+				WriteAttributesIL(writer, parameter);
+				AddEnumReference(parameter.ParameterType, enums);
+			}
+			foreach (GenericParameter parameter in method.GenericParameters)
+				writer.WriteLine("generic {0} {1}", parameter.Name, parameter.Attributes);
+			if (!method.HasBody)
+				continue;
+
+			foreach (var variable in method.Body.Variables)
+			{
+				writer.WriteLine("local {0}", variable.VariableType.FullName);
+				AddEnumReference(variable.VariableType, enums);
+			}
+			foreach (var handler in method.Body.ExceptionHandlers)
+			{
+				writer.WriteLine("handler {0} {1} {2} {3} {4}", handler.HandlerType,
+					handler.TryStart.Offset, handler.HandlerStart.Offset,
+					handler.HandlerEnd != null ? handler.HandlerEnd.Offset : -1,
+					handler.CatchType != null ? handler.CatchType.FullName : "");
+			}
+			foreach (var instruction in method.Body.Instructions)
+			{
+				writer.WriteLine(instruction);
+				var field = instruction.Operand as FieldReference;
+				var callee = instruction.Operand as MethodReference;
+				if (field != null)
+				{
+					AddEnumReference(field.DeclaringType, enums);
+					AddEnumReference(field.FieldType, enums);
+				}
+				else if (callee != null)
+				{
+					AddEnumReference(callee.ReturnType, enums);
+					foreach (ParameterDefinition parameter in callee.Parameters)
+						AddEnumReference(parameter.ParameterType, enums);
+					// Calls to accessors are decompiled as property and event accesses
+					var definition = callee as MethodDefinition;
+					if (definition != null)
+						writer.WriteLine("semantics {0}", definition.SemanticsAttributes);
+				}
+				else
+				{
+					AddEnumReference(instruction.Operand as TypeReference, enums);
+				}
+			}
+		}
+
+		foreach (TypeDefinition nested in type.NestedTypes)
+			WriteTypeIL(writer, nested, enums);
+	}
+
+	#region Protobuf extraction
+	static bool IsMessage(TypeDefinition type)
+	{
+		return type.IsClass && !type.IsEnum && type.Methods.Any(
+			m => m.Name == "Serialize" && m.Parameters.Any(p => p.ParameterType.FullName == "System.IO.Stream")
+		);
+	}
+
+	static bool IsList(TypeReference type)
+	{
+		return type is GenericInstanceType && type.Name == "List`1";
+	}
+
+	/// <summary>
+	/// Returns the name of the type in protobuf, eg. ".bnet.protocol.EntityId".
+	/// </summary>
+	static string ProtoName(TypeReference type)
+	{
+		if (type.DeclaringType == null)
+			return string.IsNullOrEmpty(type.Namespace) ? "." + type.Name : "." + type.Namespace + "." + type.Name;
+		// protobuf-csharp puts the nested types in a Types class
+		if (type.DeclaringType.Name == "Types" && type.DeclaringType.DeclaringType != null)
+			return ProtoName(type.DeclaringType.DeclaringType) + "." + type.Name;
+		return ProtoName(type.DeclaringType) + "." + type.Name;
+	}
+
+	static string ProtoFieldType(TypeReference type, bool fixedSize, bool zigZag)
+	{
+		switch (type.FullName)
+		{
+			case "System.Boolean": return "bool";
+			case "System.Single": return "float";
+			case "System.Double": return "double";
+			case "System.String": return "string";
+			case "System.Byte[]": return "bytes";
+			case "System.Int32": return fixedSize ? "sfixed32" : zigZag ? "sint32" : "int32";
+			case "System.Int64": return fixedSize ? "sfixed64" : zigZag ? "sint64" : "int64";
+			case "System.UInt32": return fixedSize ? "fixed32" : "uint32";
+			case "System.UInt64": return fixedSize ? "fixed64" : "uint64";
+		}
+		return ProtoName(type);
+	}
+
+	static bool TryGetConstant(Mono.Cecil.Cil.Instruction instruction, out int value)
+	{
+		value = 0;
+		if (instruction == null)
+			return false;
+		string name = instruction.OpCode.Name;
+		if (name == "ldc.i4.s")
+			value = (sbyte)instruction.Operand;
+		else if (name == "ldc.i4")
+			value = (int)instruction.Operand;
+		else if (name == "ldc.i4.m1")
+			value = -1;
+		else if (name.StartsWith("ldc.i4."))
+			value = name[name.Length - 1] - '0';
+		else
+			return false;
+		return true;
+	}
+
+	class ProtoField
+	{
+		public PropertyDefinition Property;
+		public int Key;
+		public bool ZigZag;
+		public bool FixedSize;
+	}
+
+	/// <summary>
+	/// Finds the fields of a message generated by SilentOrbit from its Serialize
+	/// method: each field key is written with WriteByte(), as a varint, right
+	/// before the property is read, or right after for repeated fields.
+	/// </summary>
+	static List<ProtoField> GetProtoFields(TypeDefinition type)
+	{
+		var fields = new List<ProtoField>();
+		var serialize = type.Methods.Where(
+			m => m.Name == "Serialize" && m.HasBody && m.Parameters.Any(p => p.ParameterType.FullName == "System.IO.Stream")
+		).OrderByDescending(m => m.Body.Instructions.Count).FirstOrDefault();
+		if (serialize == null)
+			return fields;
+
+		var getters = type.Properties.Where(p => p.GetMethod != null).ToDictionary(p => p.GetMethod);
+		var propertyNames = new HashSet<string>(type.Properties.Select(p => p.Name));
+		var seen = new HashSet<PropertyDefinition>();
+		ProtoField current = null;
+		PropertyDefinition last = null;
+		int key = 0, shift = 0, pendingKey = -1;
+
+		foreach (var instruction in serialize.Body.Instructions)
+		{
+			var callee = instruction.Operand as MethodReference;
+			if (callee == null)
+				continue;
+
+			int value;
+			if (callee.Name == "WriteByte" && TryGetConstant(instruction.Previous, out value))
+			{
+				key |= (value & 0x7f) << shift;
+				if ((value & 0x80) != 0)
+				{
+					shift += 7;
+					continue;
+				}
+				if (last != null && IsList(last.PropertyType) && seen.Add(last))
+				{
+					fields.Add(current = new ProtoField { Property = last, Key = key });
+					last = null;
+				}
+				else
+				{
+					pendingKey = key;
+				}
+				key = shift = 0;
+				continue;
+			}
+
+			// The encoding of the values, which for packed fields is not in the key
+			if (callee.Name.Contains("ZigZag"))
+			{
+				if (current != null)
+					current.ZigZag = true;
+				continue;
+			}
+			if (callee.Name == "Write" && callee.DeclaringType.FullName == "System.IO.BinaryWriter")
+			{
+				if (current != null)
+					current.FixedSize = true;
+				continue;
+			}
+
+			var getter = callee as MethodDefinition;
+			PropertyDefinition property;
+			if (getter == null || getter.DeclaringType != type || !getters.TryGetValue(getter, out property))
+				continue;
+			// Skip the HasFoo checks of the optional fields
+			if (property.Name.StartsWith("Has") && propertyNames.Contains(property.Name.Substring(3)))
+				continue;
+			if (pendingKey >= 0)
+			{
+				if (seen.Add(property))
+					fields.Add(current = new ProtoField { Property = property, Key = pendingKey });
+				pendingKey = -1;
+			}
+			else
+			{
+				last = property;
+			}
+		}
+		return fields;
+	}
+
+	static void WriteProtoType(TypeDefinition type, string name)
+	{
+		if (type.IsEnum)
+		{
+			Console.WriteLine("enum\t{0}", name);
+			foreach (FieldDefinition field in type.Fields.Where(f => f.IsLiteral))
+				Console.WriteLine("value\t{0}\t{1}", field.Name, field.Constant);
+			Console.WriteLine("end");
+			return;
+		}
+
+		Console.WriteLine("message\t{0}", name);
+		var propertyNames = new HashSet<string>(type.Properties.Select(p => p.Name));
+		foreach (ProtoField field in GetProtoFields(type))
+		{
+			var fieldType = field.Property.PropertyType;
+			bool repeated = IsList(fieldType);
+			if (repeated)
+				fieldType = ((GenericInstanceType)fieldType).GenericArguments[0];
+			string label = repeated ? "repeated" : propertyNames.Contains("Has" + field.Property.Name) ? "optional" : "required";
+			int wireType = field.Key & 7;
+			bool packed = repeated && wireType == 2 && fieldType.IsValueType;
+			bool fixedSize = field.FixedSize || wireType == 1 || wireType == 5;
+			Console.WriteLine("field\t{0}\t{1}\t{2}\t{3}\t{4}", label, ProtoFieldType(fieldType, fixedSize, field.ZigZag),
+				field.Property.Name, field.Key >> 3, packed ? 1 : 0);
+		}
+		foreach (TypeDefinition nested in type.NestedTypes)
+		{
+			IEnumerable<TypeDefinition> types = nested.Name == "Types" ? nested.NestedTypes : (IEnumerable<TypeDefinition>)new[] { nested };
+			foreach (TypeDefinition t in types.Where(t => t.IsEnum || IsMessage(t)))
+				WriteProtoType(t, name + "." + t.Name);
+		}
+		Console.WriteLine("end");
+	}
+
+	/// <summary>
+	/// Prints the protobuf messages and enums of the assembly, in the order
+	/// they are defined in. The other types of the namespaces of the messages
+	/// are also printed, as the files of the protos are split on them too.
+	/// </summary>
+	static void PrintProtos(string path)
+	{
+		var module = OpenAssembly(path).ModuleDefinition;
+		var namespaces = new HashSet<string>(module.Types.Where(IsMessage).Select(t => t.Namespace));
+		namespaces.Remove("");
+		foreach (TypeDefinition type in module.Types)
+		{
+			if (IsMessage(type) || (type.IsEnum && namespaces.Contains(type.Namespace)))
+				WriteProtoType(type, ProtoName(type));
+			else if (namespaces.Contains(type.Namespace))
+				Console.WriteLine("type\t{0}", ProtoName(type));
+		}
 	}
+	#endregion
 }
 
 // The remaining code in this file is taken from the ILSpy project,
@@ -119,6 +507,12 @@ namespace ICSharpCode.ILSpy
 		/// </summary>
 		public DecompilerSettings DecompilerSettings { get; set; }
 
+		/// <summary>
+		/// Gets/Sets the code files (relative to the project directory) to write
+		/// when saving a project. All of them are written if this is null.
+		/// </summary>
+		public ISet<string> CodeFiles { get; set; }
+
 		public DecompilationOptions()
 		{
 			this.DecompilerSettings = new DecompilerSettings();
@@ -662,26 +1056,34 @@ namespace ICSharpCode.ILSpy
 			}
 		}
 
-		IEnumerable<Tuple<string, string>> WriteCodeFilesInProject(ModuleDefinition module, DecompilationOptions options, HashSet<string> directories)
+		/// <summary>
+		/// Groups the types of the module by the code file they are written to.
+		/// </summary>
+		public List<IGrouping<string, TypeDefinition>> GetCodeFilesInProject(ModuleDefinition module, DecompilationOptions options)
 		{
-			var files = module.Types.Where(t => IncludeTypeWhenDecompilingProject(t, options)).GroupBy(
+			return module.Types.Where(t => IncludeTypeWhenDecompilingProject(t, options)).GroupBy(
 				delegate (TypeDefinition type) {
 					string file = TextView.DecompilerTextView.CleanUpName(type.Name) + this.FileExtension;
 					if (string.IsNullOrEmpty(type.Namespace))
-					{
 						return file;
-					}
-					else
-					{
-						string dir = TextView.DecompilerTextView.CleanUpName(type.Namespace);
-						if (directories.Add(dir))
-							Directory.CreateDirectory(Path.Combine(options.SaveAsProjectDirectory, dir));
-						return Path.Combine(dir, file);
-					}
+					return Path.Combine(TextView.DecompilerTextView.CleanUpName(type.Namespace), file);
 				}, StringComparer.OrdinalIgnoreCase).ToList();
+		}
+
+		IEnumerable<Tuple<string, string>> WriteCodeFilesInProject(ModuleDefinition module, DecompilationOptions options, HashSet<string> directories)
+		{
+			var files = GetCodeFilesInProject(module, options);
+			var written = files.Where(f => options.CodeFiles == null || options.CodeFiles.Contains(f.Key)).ToList();
+			// The resource file names depend on all the namespace directories
+			foreach (var file in files)
+			{
+				string dir = Path.GetDirectoryName(file.Key);
+				if (!string.IsNullOrEmpty(dir) && directories.Add(dir))
+					Directory.CreateDirectory(Path.Combine(options.SaveAsProjectDirectory, dir));
+			}
 			AstMethodBodyBuilder.ClearUnhandledOpcodes();
 			Parallel.ForEach(
-				files,
+				written,
 				new ParallelOptions { MaxDegreeOfParallelism = Environment.ProcessorCount },
 				delegate (IGrouping<string, TypeDefinition> file) {
 					using (StreamWriter w = new StreamWriter(Path.Combine(options.SaveAsProjectDirectory, file.Key)))
@@ -10,3 +10,4 @@ dmcs -out:build/decompile.exe ../decompile.cs \
 	-r:ICSharpCode.NRefactory.dll \
 	-r:ICSharpCode.NRefactory.CSharp.dll
 mono decompile.exe some/Assembly-CSharp.dll some/project-dir
+mono decompile.exe --hash some/Assembly-CSharp.dll
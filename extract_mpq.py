@@ -1,8 +1,13 @@
 #!/usr/bin/env python
+import hashlib
 import os
 import re
 import sys
+import tempfile
+import traceback
 import mpq
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from hearthstone import enums
 
 
@@ -55,24 +60,186 @@ STRINGS = [
 
 MPQ_REGEX = re.compile(r"hs-(\d+)-(\d+)-Win-final.MPQ")
 
+# Members are never read into memory in larger pieces than this
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def read_chunks(f, size):
+	while size:
+		chunk = f.read(min(CHUNK_SIZE, size))
+		if not chunk:
+			raise IOError("Unexpected end of %r (%i bytes missing)" % (f, size))
+		size -= len(chunk)
+		yield chunk
+
+
+def hash_file(path):
+	sha1 = hashlib.sha1()
+	with open(path, "rb") as f:
+		for chunk in read_chunks(f, os.path.getsize(path)):
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+
+def _file_mode():
+	# The mode open() gives new files; the umask can only be read by setting it
+	umask = os.umask(0)
+	os.umask(umask)
+	return 0o666 & ~umask
+
+
+FILE_MODE = _file_mode()
+
+
+def write_atomic(chunks, path):
+	"""
+	Write \a chunks to a temporary file next to \a path, fsync it and
+	rename it over \a path, so that a crash never leaves a partial file.
+	Returns the SHA-1 hex digest of the data written.
+	"""
+	sha1 = hashlib.sha1()
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			# mkstemp() creates the file as 0600
+			os.fchmod(f.fileno(), FILE_MODE)
+			for chunk in chunks:
+				sha1.update(chunk)
+				f.write(chunk)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, path)
+	except BaseException:
+		os.remove(tmp)
+		raise
+	return sha1.hexdigest()
+
+
+class ObjectStore:
+	"""
+	Content-addressed storage for extracted files.
+	Every distinct file is stored once under objects/, keyed by its SHA-1,
+	and hardlinked into the build directories. A manifest per build
+	records the hash of every extracted path.
+	"""
+	def __init__(self, path):
+		self.path = path
+
+	def object_path(self, digest):
+		return os.path.join(self.path, "objects", digest[:2], digest[2:])
+
+	def manifest_path(self, build):
+		return os.path.join(self.path, "manifests", "%s.txt" % (build))
+
+	def add(self, f, size):
+		"""
+		Add the \a size bytes of the seekable file \a f to the store.
+		The data is hashed first and only written if it is not stored yet.
+		"""
+		sha1 = hashlib.sha1()
+		for chunk in read_chunks(f, size):
+			sha1.update(chunk)
+		digest = sha1.hexdigest()
+
+		path = self.object_path(digest)
+		if not os.path.exists(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			f.seek(0)
+			if write_atomic(read_chunks(f, size), path) != digest:
+				os.remove(path)
+				raise IOError("%r changed while it was being read" % (f))
+		return digest
+
+	def link(self, digest, dest):
+		"""
+		Make \a dest point to the object \a digest.
+		Falls back to a copy if the store is on another filesystem.
+		"""
+		path = self.object_path(digest)
+		if os.path.exists(dest):
+			if os.path.samefile(path, dest):
+				return False
+			os.remove(dest)
+		try:
+			os.link(path, dest)
+		except OSError:
+			with open(path, "rb") as f:
+				write_atomic(read_chunks(f, os.path.getsize(path)), dest)
+		return True
+
+	def load_manifest(self, build):
+		path = self.manifest_path(build)
+		if not os.path.exists(path):
+			return None
+		manifest = {}
+		with open(path, "r") as f:
+			for line in f:
+				digest, filename = line.rstrip("\n").split("  ", 1)
+				manifest[filename] = digest
+		return manifest
+
+	def save_manifest(self, build, manifest):
+		path = self.manifest_path(build)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path + ".tmp", "w") as f:
+			for filename, digest in sorted(manifest.items()):
+				f.write("%s  %s\n" % (digest, filename))
+		os.replace(path + ".tmp", path)
+
+	def verify(self, build, extract_to):
+		"""
+		Return whether every file in the manifest for \a build is present
+		in \a extract_to with the expected content.
+		"""
+		manifest = self.load_manifest(build)
+		if manifest is None:
+			return False
+		for filename, digest in manifest.items():
+			path = os.path.join(extract_to, str(build), filename)
+			if not os.path.exists(path):
+				return False
+			# The object may have been pruned from the store
+			object_path = self.object_path(digest)
+			if os.path.exists(object_path) and os.path.samefile(path, object_path):
+				continue
+			if hash_file(path) != digest:
+				return False
+		return True
+
+
+def extract(mpq, build, extract_to, store=None):
+	if store and store.verify(build, extract_to):
+		print("Skipping build %s (already extracted)" % (build))
+		return
+
+	manifest = {}
 
-def extract(mpq, build, extract_to):
 	def _extract(path):
 		if path not in mpq:
 			# print("Skipping %r (not found)" % (path))
 			return
-		data = mpq.open(path).read()
-		if not data:
-			print("Skipping %r (empty)" % (path))
-			return
-		extract_path = os.path.join(extract_to, str(build), path)
-		dirname = os.path.dirname(extract_path)
-		if not os.path.exists(dirname):
-			os.makedirs(dirname)
-		print("Writing to %r" % (extract_path))
+		f = mpq.open(path)
+		try:
+			size = f.size()
+			if not size:
+				print("Skipping %r (empty)" % (path))
+				return
+			extract_path = os.path.join(extract_to, str(build), path)
+			dirname = os.path.dirname(extract_path)
+			if not os.path.exists(dirname):
+				os.makedirs(dirname)
 
-		with open(extract_path, "wb") as f:
-			f.write(data)
+			if store:
+				digest = store.add(f, size)
+				manifest[path] = digest
+				if store.link(digest, extract_path):
+					print("Linked %r" % (extract_path))
+				return
+
+			print("Writing to %r" % (extract_path))
+			write_atomic(read_chunks(f, size), extract_path)
+		finally:
+			f.close()
 
 	for path in EXTRACT:
 		_extract(path)
@@ -81,6 +248,9 @@ def extract(mpq, build, extract_to):
 		for filename in STRINGS:
 			_extract("Strings/%s/%s" % (locale.name, filename))
 
+	if store:
+		store.save_manifest(build, manifest)
+
 
 def get_builds(basepath):
 	basepath = os.path.join(basepath, "Updates")
@@ -115,17 +285,41 @@ def get_build_chains(builds):
 	return chains
 
 
-def extract_plain(path, extract_to, only=[]):
-	build = re.search(r"(\d+)", path).groups()[0]
+def extract_build(mpq, build, extract_to, store=None):
+	"""
+	Extract \a build, returning a (build, error) tuple instead of raising
+	so that one broken build does not abort the others.
+	"""
+	try:
+		extract(mpq, build, extract_to, store)
+	except Exception as e:
+		traceback.print_exc()
+		print("[%s] Extraction failed: %s" % (build, e))
+		return build, str(e)
+	print("[%s] Extraction complete" % (build))
+	return build, None
+
+
+def extract_plain(path, extract_to, only=[], store=None):
+	build = int(re.search(r"(\d+)", path).groups()[0])
+	if only and build not in only:
+		return []
 	mpqname = os.path.join(path, "base-Win.MPQ")
 	print("Opening: %r" % (mpqname))
 	base = mpq.MPQFile(mpqname)
-	if only and build not in only:
-		return
-	extract(base, build, extract_to)
+	return [extract_build(base, build, extract_to, store)]
 
 
-def extract_chain(path, chain, extract_to, only=[]):
+def extract_chain(path, chain, extract_to, only=[], store=None):
+	if only:
+		# Patches still have to be applied up to the last requested build,
+		# but nothing after it is needed.
+		wanted = [i for i, build in enumerate(chain) if build in only]
+		if not wanted:
+			return []
+		chain = chain[:wanted[-1] + 1]
+
+	ret = []
 	base_build = 0
 	mpqname = os.path.join(path, "base-Win.MPQ")
 	print("Opening: %r" % (mpqname))
@@ -133,31 +327,79 @@ def extract_chain(path, chain, extract_to, only=[]):
 	for build in chain:
 		mpqname = "hs-%i-%i-Win-final.MPQ" % (base_build, build)
 		print("Opening: %r" % (mpqname))
-		base.patch(os.path.join(path, "Updates", mpqname))
+		try:
+			base.patch(os.path.join(path, "Updates", mpqname))
+		except Exception as e:
+			traceback.print_exc()
+			print("[%s] Patching failed, skipping the rest of the chain: %s" % (build, e))
+			ret.append((build, str(e)))
+			break
 		base_build = build
 		if only and build not in only:
 			continue
-		extract(base, build, extract_to)
+		ret.append(extract_build(base, build, extract_to, store))
+
+	return ret
 
 
 def main():
-	if len(sys.argv) < 3:
-		print("Usage: %s <indir> <outdir>" % (sys.argv[0]))
-		exit(1)
+	p = ArgumentParser()
+	p.add_argument("indir")
+	p.add_argument("outdir")
+	p.add_argument("builds", nargs="*", type=int)
+	p.add_argument(
+		"--store", nargs="?", type=str,
+		help="Content-addressed store to deduplicate the extracted files in"
+	)
+	p.add_argument(
+		"-j", "--jobs", type=int, default=1,
+		help="Number of build chains to extract in parallel"
+	)
+	args = p.parse_args()
 
-	base_path = sys.argv[1]
-	extract_to = sys.argv[2]
-	filter_builds = [int(x) for x in sys.argv[3:]]
+	base_path = args.indir
+	extract_to = args.outdir
+	filter_builds = args.builds
 	direct_builds = [3140, 3388, 3749, 4243, 4944]
+	store = ObjectStore(args.store) if args.store else None
 
+	# Every direct base and every chain patched on top of it has its own
+	# MPQFile, so they can all be extracted independently.
+	tasks = []
 	for build in direct_builds:
 		path = os.path.join(base_path, "%i.direct" % (build))
 		builds = get_builds(path)
-		extract_plain(path, extract_to, only=filter_builds)
+		tasks.append((extract_plain, (path, extract_to)))
 		if builds:
 			chains = get_build_chains(builds)
 			for chain in chains:
-				extract_chain(path, chain, extract_to, only=filter_builds)
+				tasks.append((extract_chain, (path, chain, extract_to)))
+
+	kwargs = {"only": filter_builds, "store": store}
+	results = []
+	if args.jobs > 1:
+		with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+			futures = [executor.submit(func, *task_args, **kwargs) for func, task_args in tasks]
+			for (func, task_args), future in zip(tasks, futures):
+				try:
+					results += future.result()
+				except Exception as e:
+					print("Failed to process %r: %s" % (task_args[0], e))
+					results.append((task_args[0], str(e)))
+	else:
+		for func, task_args in tasks:
+			try:
+				results += func(*task_args, **kwargs)
+			except Exception as e:
+				print("Failed to process %r: %s" % (task_args[0], e))
+				results.append((task_args[0], str(e)))
+
+	errors = [(build, error) for build, error in results if error]
+	print("Extracted %i builds, %i failed" % (len(results) - len(errors), len(errors)))
+	for build, error in errors:
+		print("  %s: %s" % (build, error))
+	if errors:
+		sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Extracts the protobuf definitions of the managed assemblies of builds
+into .proto files. The messages and enums of each assembly are listed
+by `decompile.exe --protos` in the order they are defined in, and are
+split into files on the names listed in the `types` file. The index of
+each assembly is cached by its hash, so extracting the protos of every
+build only reads the assemblies that were never seen before.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+from argparse import ArgumentParser
+from commit_history import HashCache
+from decompile import BASEDIR, BUILDDIR, DECOMPILER, MONO, file_sha1
+
+
+TYPES = os.path.join(BASEDIR, "types")
+ASSEMBLIES = ("Assembly-CSharp-firstpass.dll", "Assembly-CSharp.dll")
+
+# Bump when the format of the cached indexes changes
+INDEX_VERSION = 1
+
+SCALAR_TYPES = {
+	"bool", "bytes", "double", "fixed32", "fixed64", "float", "int32", "int64",
+	"sfixed32", "sfixed64", "sint32", "sint64", "string", "uint32", "uint64",
+}
+
+
+def load_types(path=TYPES):
+	"""
+	Return a dict of the message names of \a path to the file they start.
+	"""
+	ret = {}
+	with open(path, "r") as f:
+		for line in f:
+			line = line.strip()
+			if line and not line.startswith("#"):
+				filename, name = line.split()
+				ret[name] = filename
+	return ret
+
+
+def find_assemblies(build):
+	"""
+	Return the paths of the assemblies of \a build, the firstpass first.
+	These are the assemblies decompile_code decompiles.
+	"""
+	managed = os.path.join(BUILDDIR, "extracted", str(build), "Hearthstone_Data", "Managed")
+	paths = [os.path.join(managed, name) for name in ASSEMBLIES]
+	return [path for path in paths if os.path.exists(path)]
+
+
+def parse_index(output):
+	"""
+	Parse the output of `decompile.exe --protos` into a list of the
+	messages, enums and other types of the assembly.
+	"""
+	index = []
+	stack = []
+	for line in output.splitlines():
+		kind, *values = line.split("\t")
+		if kind == "type":
+			index.append({"kind": "type", "name": values[0]})
+		elif kind in ("message", "enum"):
+			entry = {"kind": kind, "name": values[0], "fields": [], "values": [], "nested": []}
+			(stack[-1]["nested"] if stack else index).append(entry)
+			stack.append(entry)
+		elif kind == "end":
+			stack.pop()
+		elif kind == "field":
+			label, type, name, number, packed = values
+			stack[-1]["fields"].append({
+				"label": label, "type": type, "name": name, "number": int(number), "packed": packed == "1",
+			})
+		elif kind == "value":
+			stack[-1]["values"].append([values[0], int(values[1])])
+	return index
+
+
+class ProtoIndexCache:
+	"""
+	Indexes of the protobuf types of assemblies, keyed by the hash of the
+	extractor and of the assembly.
+	"""
+	def __init__(self, path, hash_cache):
+		self.path = path
+		self.hash_cache = hash_cache
+		self.extractor_hash = "%i:%s" % (INDEX_VERSION, file_sha1(DECOMPILER))
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, dll):
+		data = self.extractor_hash + "\0" + self.hash_cache.hash(dll)
+		path = os.path.join(self.path, hashlib.sha1(data.encode("utf-8")).hexdigest() + ".json")
+		if os.path.exists(path):
+			self.hits += 1
+			with open(path, "r") as f:
+				return json.load(f)
+
+		self.misses += 1
+		output = subprocess.check_output([MONO, DECOMPILER, "--protos", dll]).decode("utf-8")
+		index = parse_index(output)
+		os.makedirs(self.path, exist_ok=True)
+		with open(path + ".tmp", "w") as f:
+			json.dump(index, f)
+		os.replace(path + ".tmp", path)
+		return index
+
+
+def split_files(indexes, types):
+	"""
+	Return a dict of the proto files to their top-level messages and
+	enums. A file starts at each of the names of \a types, in the order
+	the types are defined in each of \a indexes.
+	"""
+	ret = {}
+	for index in indexes:
+		filename = None
+		for entry in index:
+			filename = types.get(entry["name"], filename)
+			if filename and entry["kind"] != "type":
+				ret.setdefault(filename, []).append(entry)
+	return ret
+
+
+def walk(entries):
+	for entry in entries:
+		yield entry
+		yield from walk(entry["nested"])
+
+
+def snake_case(name):
+	return re.sub(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])", "_", name).lower()
+
+
+def render_entry(entry, indent=""):
+	name = entry["name"].rsplit(".", 1)[-1]
+	lines = ["%s%s %s {" % (indent, entry["kind"], name)]
+	if entry["kind"] == "enum":
+		for value_name, value in entry["values"]:
+			lines.append("%s\t%s = %i;" % (indent, value_name, value))
+	else:
+		for nested in entry["nested"]:
+			lines += render_entry(nested, indent + "\t")
+		for field in entry["fields"]:
+			options = " [packed=true]" if field["packed"] else ""
+			lines.append("%s\t%s %s %s = %i%s;" % (
+				indent, field["label"], field["type"], snake_case(field["name"]), field["number"], options
+			))
+	lines.append(indent + "}")
+	return lines
+
+
+def render_proto(filename, entries, locations):
+	"""
+	Return the content of the .proto file \a filename. \a locations maps
+	every message and enum to the file it is in, for the imports.
+	"""
+	packages = set(entry["name"].lstrip(".").rpartition(".")[0] for entry in entries)
+	package = entries[0]["name"].lstrip(".").rpartition(".")[0]
+	if len(packages) > 1:
+		sys.stderr.write("[WARN] %s has types from several packages: %s\n" % (
+			filename, ", ".join(sorted(packages))
+		))
+
+	imports = set()
+	for entry in walk(entries):
+		for field in entry["fields"]:
+			location = locations.get(field["type"])
+			if field["type"] not in SCALAR_TYPES and location and location != filename:
+				imports.add(location)
+
+	lines = ['syntax = "proto2";', ""]
+	if package:
+		lines += ["package %s;" % (package), ""]
+	if imports:
+		lines += ['import "%s.proto";' % (location) for location in sorted(imports)] + [""]
+	for entry in entries:
+		lines += render_entry(entry) + [""]
+	return "\n".join(lines)
+
+
+def extract(build, types, cache, outdir):
+	dlls = find_assemblies(build)
+	if not dlls:
+		print("No assemblies found for build %s" % (build))
+		return False
+
+	files = split_files([cache.get(dll) for dll in dlls], types)
+	locations = {}
+	for filename, entries in files.items():
+		for entry in walk(entries):
+			locations[entry["name"]] = filename
+
+	staging = outdir + ".tmp"
+	if os.path.exists(staging):
+		shutil.rmtree(staging)
+	os.makedirs(staging)
+	for filename, entries in sorted(files.items()):
+		path = os.path.join(staging, filename + ".proto")
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w") as f:
+			f.write(render_proto(filename, entries, locations))
+
+	if os.path.exists(outdir):
+		shutil.rmtree(outdir)
+	os.rename(staging, outdir)
+	print("Wrote %i proto files to %s" % (len(files), outdir))
+	return True
+
+
+def main():
+	p = ArgumentParser()
+	p.add_argument("builds", nargs="*", type=int)
+	p.add_argument("--all", action="store_true", help="Extract the protos of every extracted build")
+	p.add_argument("--types", type=str, default=TYPES, help="The mapping of the messages to their files")
+	p.add_argument("--outdir", type=str, default=os.path.join(BUILDDIR, "protos"))
+	p.add_argument(
+		"--cache-dir", type=str, default=os.path.join(BUILDDIR, "proto-cache"),
+		help="Where to keep the indexes of the assemblies between runs"
+	)
+	args = p.parse_args()
+
+	builds = args.builds
+	if args.all:
+		extracted = os.path.join(BUILDDIR, "extracted")
+		builds = sorted(int(build) for build in os.listdir(extracted) if build.isdigit())
+	if not builds:
+		p.error("No builds to extract")
+
+	types = load_types(args.types)
+	hash_cache = HashCache(os.path.join(args.cache_dir, "hashes.json"))
+	cache = ProtoIndexCache(args.cache_dir, hash_cache)
+	ok = True
+	try:
+		for build in builds:
+			# Some builds do not have the assemblies, only fail on the requested ones
+			if not extract(build, types, cache, os.path.join(args.outdir, str(build))) and not args.all:
+				ok = False
+	finally:
+		hash_cache.save()
+
+	print("Read %i assemblies, %i indexes from the cache" % (cache.misses, cache.hits))
+	if not ok:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -4,10 +4,12 @@ set -e
 
 BASEDIR="$(readlink -f $(dirname $0))"
 BUILD="$1"
+# Optional single stage to run, used by pipeline.py
+STAGE="$2"
 
 isnum='^[0-9]+$'
 if ! [[ $BUILD =~ $isnum ]]; then
-	>&2 echo "USAGE: $0 [BUILD]"
+	>&2 echo "USAGE: $0 [BUILD] [STAGE]"
 	exit 1
 fi
 
@@ -20,6 +22,9 @@ BUILDDIR="$BASEDIR/build"
 # Directory where processed CardDefs.xml go
 PROCESSED_DIR="$BUILDDIR/processed/$BUILD"
 
+# Per-entity state of each processed CardDefs.xml, for incremental processing
+CARDXML_STATE_DIR="$BUILDDIR/cardxml-state"
+
 # Directory storing the 'hsb' blte config
 HSBDIR="$DATADIR/hsb"
 
@@ -47,11 +52,14 @@ HSBUILDDIR="$BUILDDIR/extracted/$BUILD"
 # Patch downloader
 DOWNLOAD_BIN="$HOME/bin/ngdp-get"
 
-# ILSpy decompiler script
-DECOMPILER_BIN="mono $BASEDIR/decompiler/build/decompile.exe"
+# ILSpy decompiler driver, only decompiles the types whose IL changed
+DECOMPILER_BIN="$BASEDIR/decompile.py"
 
 DECOMPILED_DIR="$BUILDDIR/decompiled/$BUILD"
 
+# Protobuf extractor, split into files according to the types file
+PROTO_EXTRACT_BIN="$BASEDIR/extract_protos.py"
+
 # Autocommit script
 COMMIT_BIN="$BASEDIR/commit.sh"
 
@@ -64,15 +72,19 @@ TEXTUREGEN_BIN="$HEARTHSTONEJSON_GIT/generate_card_textures.py"
 # Card texture generate script
 TEXTURESYNC_BIN="$HEARTHSTONEJSON_GIT/generate.sh"
 
+# Cross-build card history index
+CARD_HISTORY_BIN="$BASEDIR/card_history.py"
+
 # Smartdiff generation script
 SMARTDIFF_BIN="$BASEDIR/smartdiff_cardxml.py"
 
 # Smartdiff output file
 SMARTDIFF_OUT="$HOME/smartdiff-$BUILD.txt"
 
-# hscode/hsdata git repositories
+# hscode/hsdata/hsproto git repositories
 HSCODE_GIT="$BASEDIR/hscode.git"
 HSDATA_GIT="$BASEDIR/hsdata.git"
+HSPROTO_GIT="$BASEDIR/hsproto.git"
 
 # CardDefs.xml path for the build
 CARDDEFS_XML="$HSDATA_GIT/CardDefs.xml"
@@ -94,7 +106,7 @@ function upgrade_venv() {
 
 function update_repositories() {
 	echo "Updating repositories"
-	repos=("$BASEDIR" "$HEARTHSTONEJSON_GIT" "$HSDATA_GIT" "$HSCODE_GIT")
+	repos=("$BASEDIR" "$HEARTHSTONEJSON_GIT" "$HSDATA_GIT" "$HSCODE_GIT" "$HSPROTO_GIT")
 
 	if [[ ! -d "$HEARTHSTONEJSON_GIT" ]]; then
 		git clone git@github.com:HearthSim/HearthstoneJSON.git "$HEARTHSTONEJSON_GIT"
@@ -108,6 +120,10 @@ function update_repositories() {
 		git clone git@github.com:HearthSim/hscode.git "$HSCODE_GIT"
 	fi
 
+	if [[ ! -d "$HSPROTO_GIT" ]]; then
+		git clone git@github.com:HearthSim/hsproto.git "$HSPROTO_GIT"
+	fi
+
 	for repo in $repos; do
 		git -C "$repo" pull
 	done
@@ -156,17 +172,32 @@ function process_cardxml() {
 	datadir="$HSBUILDDIR/Data"
 	dbf=$(find -L "$HSBUILDDIR" -name DBF -type d)
 
+	# Only reprocess the entities that changed since the latest processed build
+	mkdir -p "$CARDXML_STATE_DIR"
+	statefile="$CARDXML_STATE_DIR/$BUILD.state"
+	basestate=$(find "$CARDXML_STATE_DIR" -name '*.state' ! -name "$BUILD.state" | sort -V | tail -n1)
+	stateargs=(--save-state="$statefile")
+	if [[ ! -z $basestate ]]; then
+		stateargs+=(--base="$basestate")
+	fi
+
 	if [[ ! -z $dbf ]]; then
 		cp -rf "$dbf" -t "$PROCESSED_DIR"
-		"$PROCESS_CARDXML_BIN" $(find -L "$datadir" -name 'card*.unity3d' -type f) -o "$outfile" --dbf-dir="$dbf"
+		"$PROCESS_CARDXML_BIN" $(find -L "$datadir" -name 'card*.unity3d' -type f) -o "$outfile" --dbf-dir="$dbf" $stateargs
 	else
 		csv="$HSBUILDDIR/manifest-cards.csv"
-		"$PROCESS_CARDXML_BIN" $(find -L "$datadir" -name 'card*.unity3d' -type f) -o "$outfile" --manifest-csv="$csv"
+		"$PROCESS_CARDXML_BIN" $(find -L "$datadir" -name 'card*.unity3d' -type f) -o "$outfile" --manifest-csv="$csv" $stateargs
 	fi
 	cp -rf "$HSBUILDDIR/Strings" -t "$PROCESSED_DIR"
 }
 
 
+function update_card_history() {
+	echo "Adding $BUILD to the card history index"
+	"$CARD_HISTORY_BIN" add "$BUILD" "$PROCESSED_DIR/CardDefs.xml"
+}
+
+
 function decompile_code() {
 	mkdir -p "$PROCESSED_DIR"
 
@@ -179,6 +210,12 @@ function decompile_code() {
 }
 
 
+function extract_protos() {
+	echo "Extracting the protobuf definitions"
+	"$PROTO_EXTRACT_BIN" "$BUILD"
+}
+
+
 function generate_git_repositories() {
 	echo "Generating git repositories"
 	if ! git -C "$HSDATA_GIT" rev-parse "$BUILD" &>/dev/null; then
@@ -190,17 +227,14 @@ function generate_git_repositories() {
 	echo "Pushing to GitHub"
 	git -C "$HSDATA_GIT" push --follow-tags -f
 	git -C "$HSCODE_GIT" push --follow-tags -f
+	git -C "$HSPROTO_GIT" push --follow-tags -f
 }
 
 
 function generate_smartdiff() {
-	git -C "$HSDATA_GIT" show "$BUILD:CardDefs.xml" > /tmp/new.xml
-	git -C "$HSDATA_GIT" show "$BUILD~:CardDefs.xml" > /tmp/old.xml
-
 	echo "Generating smartdiff"
-	"$SMARTDIFF_BIN" "/tmp/old.xml" "/tmp/new.xml" > "$SMARTDIFF_OUT"
+	"$SMARTDIFF_BIN" --repo "$HSDATA_GIT" "$BUILD~" "$BUILD" > "$SMARTDIFF_OUT"
 	echo "Generated smartdiff in $SMARTDIFF_OUT"
-	rm /tmp/new.xml /tmp/old.xml
 }
 
 
@@ -227,7 +261,9 @@ function main() {
 	check_commit_sh
 	prepare_patch_directories
 	process_cardxml
+	update_card_history
 	decompile_code
+	extract_protos
 	generate_git_repositories
 	generate_smartdiff
 	extract_card_textures
@@ -237,4 +273,11 @@ function main() {
 }
 
 
-main "$@"
+if [[ -z $STAGE ]]; then
+	main "$@"
+elif typeset -f "$STAGE" > /dev/null && [[ $STAGE != main ]]; then
+	"$STAGE"
+else
+	>&2 echo "Unknown stage: $STAGE"
+	exit 1
+fi
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+Runs the stages of patch_pipeline.sh for a build as a dependency graph.
+Independent stages run concurrently, and stages whose inputs did not
+change since their last successful run are skipped.
+"""
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from subprocess import Popen, STDOUT
+from threading import Lock
+
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_BIN = os.path.join(BASEDIR, "patch_pipeline.sh")
+
+# Same layout as the variables of patch_pipeline.sh
+BUILDDIR = os.path.join(BASEDIR, "build")
+PATHS = {
+	"basedir": BASEDIR,
+	"builddir": BUILDDIR,
+	"hsbuilddir": os.path.join(BUILDDIR, "extracted", "{build}"),
+	"processed_dir": os.path.join(BUILDDIR, "processed", "{build}"),
+	"cardxml_state_dir": os.path.join(BUILDDIR, "cardxml-state"),
+	"decompiled_dir": os.path.join(BUILDDIR, "decompiled", "{build}"),
+	"protos_dir": os.path.join(BUILDDIR, "protos", "{build}"),
+	"smartdiff_out": os.path.join(os.path.expanduser("~"), "smartdiff-{build}.txt"),
+}
+
+# Where the input hashes, timings and logs of every run are kept
+STATE_DIR = os.path.join(BUILDDIR, "pipeline")
+
+
+class Stage:
+	"""
+	A function of patch_pipeline.sh. Stages with \a inputs (glob
+	patterns) are skipped when the inputs are unchanged and all the
+	\a outputs exist; stages without inputs always run.
+	"""
+	def __init__(self, name, deps=(), inputs=(), outputs=()):
+		self.name = name
+		self.deps = deps
+		self.inputs = inputs
+		self.outputs = outputs
+
+
+STAGES = [
+	Stage("upgrade_venv"),
+	Stage("update_repositories", deps=("upgrade_venv", )),
+	Stage("check_commit_sh", deps=("update_repositories", )),
+	Stage("prepare_patch_directories", deps=("check_commit_sh", )),
+	Stage(
+		"process_cardxml", deps=("prepare_patch_directories", ),
+		inputs=(
+			"{hsbuilddir}/Data/**/card*.unity3d",
+			"{hsbuilddir}/**/DBF/*.xml",
+			"{hsbuilddir}/manifest-cards.csv",
+			"{hsbuilddir}/Strings/**/*",
+			"{basedir}/process_cardxml.py",
+		),
+		outputs=("{processed_dir}/CardDefs.xml", "{cardxml_state_dir}/{build}.state"),
+	),
+	Stage(
+		"update_card_history", deps=("process_cardxml", ),
+		inputs=("{processed_dir}/CardDefs.xml", "{basedir}/card_history.py"),
+		outputs=("{builddir}/card-history.db", ),
+	),
+	Stage(
+		"decompile_code", deps=("prepare_patch_directories", ),
+		inputs=(
+			"{hsbuilddir}/Hearthstone_Data/Managed/Assembly-CSharp*.dll",
+			"{basedir}/decompiler/build/decompile.exe",
+			"{basedir}/decompile.py",
+		),
+		outputs=("{decompiled_dir}", ),
+	),
+	Stage(
+		"extract_protos", deps=("prepare_patch_directories", ),
+		inputs=(
+			"{hsbuilddir}/Hearthstone_Data/Managed/Assembly-CSharp*.dll",
+			"{basedir}/decompiler/build/decompile.exe",
+			"{basedir}/extract_protos.py",
+			"{basedir}/types",
+		),
+		outputs=("{protos_dir}", ),
+	),
+	# Commits and pushes; checks by itself whether the tag exists
+	Stage("generate_git_repositories", deps=("process_cardxml", "decompile_code", "extract_protos")),
+	Stage(
+		"generate_smartdiff", deps=("generate_git_repositories", ),
+		inputs=("{processed_dir}/CardDefs.xml", "{basedir}/smartdiff_cardxml.py"),
+		outputs=("{smartdiff_out}", ),
+	),
+	Stage(
+		"extract_card_textures", deps=("prepare_patch_directories", ),
+		inputs=("{hsbuilddir}/Data/Win/card*.unity3d", "{hsbuilddir}/Data/Win/shared*.unity3d"),
+	),
+	# Checks by itself whether the build was already generated
+	Stage("update_hearthstonejson", deps=("generate_git_repositories", )),
+]
+
+
+class Pipeline:
+	def __init__(self, build, stages, jobs, force=False):
+		self.build = build
+		self.stages = {stage.name: stage for stage in stages}
+		self.jobs = jobs
+		self.force = force
+		self.paths = {k: v.format(build=build) for k, v in PATHS.items()}
+		self.state_path = os.path.join(STATE_DIR, "%s.json" % (build))
+		self.log_dir = os.path.join(STATE_DIR, str(build))
+		self.state = self.load_state()
+		self.results = {}
+		self.timings = {}
+		# Stages update the state from their own threads
+		self.lock = Lock()
+
+	def load_state(self):
+		if os.path.exists(self.state_path):
+			with open(self.state_path, "r") as f:
+				return json.load(f)
+		return {"files": {}, "stages": {}}
+
+	def save_state(self):
+		os.makedirs(STATE_DIR, exist_ok=True)
+		with self.lock, open(self.state_path + ".tmp", "w") as f:
+			json.dump(self.state, f, indent="\t", sort_keys=True)
+		os.replace(self.state_path + ".tmp", self.state_path)
+
+	def expand(self, pattern):
+		return pattern.format(build=self.build, **self.paths)
+
+	def file_hash(self, path):
+		"""
+		SHA-1 of the file at \a path, only rehashed when its size or
+		modification time changed since the last run.
+		"""
+		st = os.stat(path)
+		known = self.state["files"].get(path)
+		if known and known[:2] == [st.st_size, st.st_mtime_ns]:
+			return known[2]
+		sha1 = hashlib.sha1()
+		with open(path, "rb") as f:
+			for chunk in iter(lambda: f.read(1024 * 1024), b""):
+				sha1.update(chunk)
+		with self.lock:
+			self.state["files"][path] = [st.st_size, st.st_mtime_ns, sha1.hexdigest()]
+		return sha1.hexdigest()
+
+	def input_hash(self, stage):
+		sha1 = hashlib.sha1()
+		for pattern in stage.inputs:
+			sha1.update(pattern.encode("utf-8") + b"\0")
+			for path in sorted(glob.glob(self.expand(pattern), recursive=True)):
+				if os.path.isfile(path):
+					sha1.update(path.encode("utf-8") + b"\0")
+					sha1.update(self.file_hash(path).encode("utf-8"))
+		return sha1.hexdigest()
+
+	def is_fresh(self, stage, input_hash):
+		if self.force or not stage.inputs:
+			return False
+		previous = self.state["stages"].get(stage.name, {})
+		if previous.get("status") != "ok" or previous.get("inputs") != input_hash:
+			return False
+		return all(os.path.exists(self.expand(output)) for output in stage.outputs)
+
+	def run_stage(self, stage):
+		"""
+		Run \a stage in a subprocess and return its (status, wall time,
+		peak RSS in KB of its largest process) if it was run, None if it
+		was skipped.
+		"""
+		input_hash = self.input_hash(stage) if stage.inputs else None
+		if self.is_fresh(stage, input_hash):
+			return None
+
+		os.makedirs(self.log_dir, exist_ok=True)
+		log_path = os.path.join(self.log_dir, stage.name + ".log")
+		start = time.monotonic()
+		with open(log_path, "wb") as log:
+			proc = Popen([PIPELINE_BIN, str(self.build), stage.name], stdout=log, stderr=STDOUT)
+			# wait4() reports the largest peak RSS of any single process of the
+			# stage and its children, not the total memory of the stage
+			pid, status, rusage = os.wait4(proc.pid, 0)
+			proc.returncode = os.waitstatus_to_exitcode(status)
+		elapsed = time.monotonic() - start
+
+		ok = proc.returncode == 0
+		with self.lock:
+			self.state["stages"][stage.name] = {
+				"status": "ok" if ok else "failed",
+				"inputs": input_hash,
+				"time": elapsed,
+				"maxrss": rusage.ru_maxrss,
+			}
+		return ok, elapsed, rusage.ru_maxrss
+
+	def run(self):
+		"""
+		Run every stage once its dependencies completed, and return
+		whether all of them succeeded.
+		"""
+		pending = dict(self.stages)
+		running = {}
+		failed = False
+
+		with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+			while pending or running:
+				if not failed:
+					for name, stage in list(pending.items()):
+						if all(self.results.get(dep) in ("ok", "skipped") for dep in stage.deps):
+							print("[%s] Starting" % (name))
+							running[executor.submit(self.run_stage, stage)] = stage
+							del pending[name]
+
+				if not running:
+					break
+
+				done, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in done:
+					stage = running.pop(future)
+					try:
+						result = future.result()
+					except Exception as e:
+						print("[%s] Error: %s" % (stage.name, e))
+						result = False, 0, 0
+
+					if result is None:
+						self.results[stage.name] = "skipped"
+						print("[%s] Inputs unchanged, skipped" % (stage.name))
+						continue
+
+					ok, elapsed, maxrss = result
+					self.results[stage.name] = "ok" if ok else "failed"
+					self.timings[stage.name] = elapsed, maxrss
+					print("[%s] %s in %.1fs, largest process peak RSS %.1f MB" % (
+						stage.name, "Completed" if ok else "FAILED", elapsed, maxrss / 1024
+					))
+					if not ok:
+						print("[%s] See %s" % (stage.name, os.path.join(self.log_dir, stage.name + ".log")))
+						failed = True
+				self.save_state()
+
+		for name in pending:
+			self.results[name] = "not run"
+		return not failed
+
+	def critical_path(self):
+		"""
+		Return the chain of stages with the longest total time in this
+		run, along with that time.
+		"""
+		times = {name: self.timings.get(name, (0.0, 0))[0] for name in self.stages}
+		finish = {}
+		path = {}
+		# STAGES lists dependencies before their dependents
+		for name, stage in self.stages.items():
+			before = max(stage.deps, key=lambda dep: finish[dep], default=None)
+			finish[name] = times[name] + (finish[before] if before else 0.0)
+			path[name] = (path[before] if before else []) + [name]
+
+		end = max(finish, key=finish.get)
+		return path[end], finish[end]
+
+	def report(self, elapsed):
+		print("\nStage summary for build %s (peak RSS of the largest process):" % (self.build))
+		for name in self.stages:
+			result = self.results.get(name, "not run")
+			if name in self.timings:
+				stage_time, maxrss = self.timings[name]
+				print("  %-28s %-8s %8.1fs %10.1f MB" % (name, result, stage_time, maxrss / 1024))
+			else:
+				print("  %-28s %s" % (name, result))
+
+		path, path_time = self.critical_path()
+		total = sum(stage_time for stage_time, maxrss in self.timings.values())
+		print("Critical path: %s (%.1fs)" % (" -> ".join(path), path_time))
+		print("Total stage time %.1fs, wall time %.1fs" % (total, elapsed))
+
+
+def main():
+	p = ArgumentParser()
+	p.add_argument("build", type=int)
+	p.add_argument(
+		"-j", "--jobs", type=int, default=len(STAGES),
+		help="Maximum number of stages to run concurrently"
+	)
+	p.add_argument("--force", action="store_true", help="Run every stage, even if its inputs are unchanged")
+	args = p.parse_args()
+
+	pipeline = Pipeline(args.build, STAGES, args.jobs, args.force)
+	start = time.monotonic()
+	ok = pipeline.run()
+	pipeline.report(time.monotonic() - start)
+
+	if not ok:
+		sys.exit(1)
+	print("Build %s completed" % (args.build))
+
+
+if __name__ == "__main__":
+	main()
@@ -1,16 +1,26 @@
 #!/usr/bin/env python
 
+import cProfile
 import csv
+import hashlib
+import json
 import os
+import pickle
 import re
+import resource
+import sqlite3
 import sys
+import time
 import unitypack
 from argparse import ArgumentParser, FileType
-from xml.dom import minidom
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from lxml import etree as ElementTree
+import hearthstone
 from hearthstone import cardxml
 from hearthstone.dbf import Dbf
-from hearthstone.enums import GameTag
+from hearthstone.enums import GameTag, Locale
 
 
 MISSING_HERO_POWERS = {
@@ -20,13 +30,490 @@ MISSING_HERO_POWERS = {
 
 IGNORE_LOCALES = ("enGB", "ptPT")
 
-SPARE_PART_RE = re.compile(r"PART_\d+")
+OVERLOAD_RE = re.compile(r"Overload[^(]+\((\d+)\)")
+
+SPELLPOWER_RE = re.compile(r"Spell (?:Power|Damage)(?:</b>)? \+(\d+)")
+
+# Bump whenever a change to the processing invalidates saved states
+STATE_VERSION = 1
+
+# Bump whenever a change to the loaders invalidates the cached DBF indexes
+DBF_CACHE_VERSION = 1
+
+
+def _escape_xml(s):
+	# Same escaping as minidom's toprettyxml() in both text and attributes
+	return s.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def _pretty_element(element, indent, out):
+	"""
+	Serialize \a element into the \a out list the same way
+	minidom's toprettyxml(indent="\t") does, without building a DOM.
+	"""
+	out.append("%s<%s" % (indent, element.tag))
+	for name, value in element.attrib.items():
+		out.append(" %s=\"%s\"" % (name, _escape_xml(value)))
+
+	children = []
+	if element.text:
+		children.append(element.text)
+	for child in element:
+		children.append(child)
+		if child.tail:
+			children.append(child.tail)
+
+	if not children:
+		out.append("/>\n")
+	elif len(children) == 1 and isinstance(children[0], str):
+		out.append(">%s</%s>\n" % (_escape_xml(children[0]), element.tag))
+	else:
+		out.append(">\n")
+		for child in children:
+			if isinstance(child, str):
+				out.append("%s\t%s\n" % (indent, _escape_xml(child)))
+			else:
+				_pretty_element(child, indent + "\t", out)
+		out.append("%s</%s>\n" % (indent, element.tag))
+
+
+def _strip_blank_lines(data):
+	return b"\n".join(line for line in data.split(b"\n") if line.strip())
+
+
+class PrettyXMLWriter:
+	"""
+	Incremental pretty-printer for a flat document: a root element
+	whose children are written one at a time with write().
+	The output is byte-identical to pretty_xml() on the full tree,
+	but only a single child is ever held in memory.
+	"""
+	def __init__(self, f, tag, **attrib):
+		self.f = f
+		self.tag = tag
+		self.count = 0
+		root = ["<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<%s" % (tag)]
+		for name, value in attrib.items():
+			root.append(" %s=\"%s\"" % (name, _escape_xml(value)))
+		self.f.write("".join(root).encode("utf-8"))
+
+	def serialize(self, element):
+		"""
+		Return the bytes that write() would output for \a element.
+		"""
+		out = []
+		_pretty_element(element, "\t", out)
+		return _strip_blank_lines("".join(out).encode("utf-8"))
+
+	def write(self, element):
+		self.write_raw(self.serialize(element))
+
+	def write_raw(self, data):
+		# The separator goes before the element so the document never ends in a newline
+		self.f.write(b">\n" if not self.count else b"\n")
+		self.f.write(data)
+		self.count += 1
+
+	def close(self):
+		if self.count:
+			self.f.write(("\n</%s>" % (self.tag)).encode("utf-8"))
+		else:
+			self.f.write(b"/>")
 
 
 def pretty_xml(xml):
-	ret = ElementTree.tostring(xml, encoding="utf-8")
-	ret = minidom.parseString(ret).toprettyxml(indent="\t", encoding="utf-8")
-	return b"\n".join(line for line in ret.split(b"\n") if line.strip())
+	ret = []
+	_pretty_element(xml, "", ret)
+	ret = "<?xml version=\"1.0\" encoding=\"utf-8\"?>\n" + "".join(ret)
+	return _strip_blank_lines(ret.encode("utf-8"))
+
+
+def _iterparse(path, tags):
+	"""
+	Yield the elements of \a path matching \a tags as they are parsed,
+	discarding them afterwards so the tree never grows.
+	"""
+	for event, element in ElementTree.iterparse(path, events=("end", ), tag=tags):
+		yield element
+		element.clear()
+		while element.getprevious() is not None:
+			del element.getparent()[0]
+
+
+def read_dbf(path):
+	"""
+	Incremental equivalent of hearthstone.dbf.Dbf.load()
+	"""
+	dbf = Dbf()
+	for element in _iterparse(path, ("SourceFingerprint", "Column", "Record")):
+		if dbf.name is None:
+			dbf.name = element.getparent().attrib.get("name", "")
+		if element.tag == "Record":
+			dbf.records.append(dbf._deserialize_record(element))
+		elif element.tag == "Column":
+			dbf.columns[element.attrib["name"]] = element.attrib["type"]
+		else:
+			dbf.source_fingerprint = element.text
+	return dbf
+
+
+class CardTagTable:
+	"""
+	Columnar store for the rows of CARD_TAG.xml, sorted by card.
+	"""
+	def __init__(self):
+		self.card_ids = array("i")
+		self.tag_ids = array("i")
+		self.values = array("q")
+		self.is_reference = array("b")
+		# Records missing a card, tag or value, which are not loaded
+		self.skipped = []
+
+	def __len__(self):
+		return len(self.card_ids)
+
+	@classmethod
+	def from_dbf(cls, path):
+		columns = ("CARD_ID", "TAG_ID", "TAG_VALUE", "IS_REFERENCE_TAG")
+		rows = []
+		skipped = []
+		for element in _iterparse(path, "Record"):
+			row = dict.fromkeys(columns)
+			for field in element:
+				column = field.attrib["column"]
+				if column in row and field.text is not None and field.text.strip():
+					row[column] = field.text
+			if row["CARD_ID"] is None or row["TAG_ID"] is None or row["TAG_VALUE"] is None:
+				skipped.append((row["CARD_ID"], row["TAG_ID"], row["TAG_VALUE"]))
+				continue
+			rows.append((
+				int(row["CARD_ID"]), int(row["TAG_ID"]), int(row["TAG_VALUE"]),
+				row["IS_REFERENCE_TAG"] == "True",
+			))
+
+		# Stable, so that later rows for the same card still win
+		rows.sort(key=lambda row: row[0])
+		ret = cls()
+		ret.skipped = skipped
+		for card_id, tag_id, value, is_reference in rows:
+			ret.card_ids.append(card_id)
+			ret.tag_ids.append(tag_id)
+			ret.values.append(value)
+			ret.is_reference.append(is_reference)
+		return ret
+
+	def groupby_card(self):
+		"""
+		Yield (card_id, rows) pairs, where rows is a list of
+		(tag_id, value, is_reference) tuples in file order.
+		"""
+		start = 0
+		count = len(self)
+		while start < count:
+			card_id = self.card_ids[start]
+			end = start
+			while end < count and self.card_ids[end] == card_id:
+				end += 1
+			yield card_id, list(zip(
+				self.tag_ids[start:end], self.values[start:end], self.is_reference[start:end]
+			))
+			start = end
+
+
+def file_fingerprint(path):
+	sha1 = hashlib.sha1()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+
+class StringTable:
+	"""
+	Deduplicates the text of localized strings, so that identical
+	texts share a single object across entities and locales, and
+	normalizes each distinct text only once.
+	"""
+	__slots__ = ("_strings", "_normalized")
+
+	def __init__(self):
+		self._strings = {}
+		self._normalized = {}
+
+	def __len__(self):
+		return len(self._strings)
+
+	def add(self, s):
+		if s is None:
+			return s
+		return self._strings.setdefault(s, s)
+
+	def normalize(self, s):
+		ret = self._normalized.get(s)
+		if ret is None:
+			ret = self._normalized[s] = s.replace("\\n", "\n").strip()
+		return ret
+
+
+class Metrics:
+	"""
+	Timed spans and counters of a run, along with its peak memory usage.
+	Spans with the same name and labels are accumulated.
+	"""
+	prefix = "process_cardxml"
+
+	def __init__(self):
+		self.spans = {}
+		self.counters = {}
+		self.start = time.perf_counter()
+
+	@contextmanager
+	def span(self, name, **labels):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add_span(name, time.perf_counter() - start, **labels)
+
+	def add_span(self, name, seconds, count=1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		span = self.spans.setdefault(key, [0, 0.0])
+		span[0] += count
+		span[1] += seconds
+
+	def count(self, name, n=1):
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	@staticmethod
+	def peak_rss():
+		"""
+		Peak RSS in bytes of the process and of its finished workers.
+		"""
+		# ru_maxrss is in kilobytes, except on macOS
+		unit = 1 if sys.platform == "darwin" else 1024
+		return max(
+			resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+		) * unit
+
+	def to_dict(self):
+		return {
+			"elapsed": time.perf_counter() - self.start,
+			"peak_rss": self.peak_rss(),
+			"counters": dict(sorted(self.counters.items())),
+			"spans": [
+				{"name": name, "labels": dict(labels), "count": count, "seconds": seconds}
+				for (name, labels), (count, seconds) in sorted(self.spans.items())
+			],
+		}
+
+	def write_json(self, f, **info):
+		data = self.to_dict()
+		data.update(info)
+		json.dump(data, f, indent="\t", sort_keys=True)
+		f.write("\n")
+
+	def write_prometheus(self, f, **info):
+		"""
+		Write the metrics in the Prometheus text exposition format,
+		with \a info as the labels of an info metric.
+		"""
+		def format_labels(labels):
+			if not labels:
+				return ""
+			escaped = (
+				(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+				for k, v in labels
+			)
+			return "{%s}" % (",".join('%s="%s"' % (k, v) for k, v in escaped))
+
+		data = self.to_dict()
+		p = self.prefix
+		f.write("# TYPE %s_info gauge\n" % (p))
+		f.write("%s_info%s 1\n" % (p, format_labels(sorted(info.items()))))
+		f.write("# TYPE %s_elapsed_seconds gauge\n" % (p))
+		f.write("%s_elapsed_seconds %f\n" % (p, data["elapsed"]))
+		f.write("# TYPE %s_peak_rss_bytes gauge\n" % (p))
+		f.write("%s_peak_rss_bytes %i\n" % (p, data["peak_rss"]))
+		for name, value in data["counters"].items():
+			f.write("# TYPE %s_%s_total counter\n" % (p, name))
+			f.write("%s_%s_total %i\n" % (p, name, value))
+
+		f.write("# TYPE %s_span_seconds_total counter\n" % (p))
+		for (name, labels), (count, seconds) in sorted(self.spans.items()):
+			labels = format_labels((("span", name), ) + labels)
+			f.write("%s_span_seconds_total%s %f\n" % (p, labels, seconds))
+		f.write("# TYPE %s_span_count_total counter\n" % (p))
+		for (name, labels), (count, seconds) in sorted(self.spans.items()):
+			labels = format_labels((("span", name), ) + labels)
+			f.write("%s_span_count_total%s %i\n" % (p, labels, count))
+
+
+class CardDB:
+	"""
+	Writes the processed entities to an indexed SQLite database, as
+	an alternative to parsing the whole CardDefs.xml for lookups.
+	The database is written to a temporary file and moved to \a path
+	once complete.
+	"""
+	schema = """
+	CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+	CREATE TABLE game_tag (tag INTEGER PRIMARY KEY, name TEXT NOT NULL);
+	CREATE TABLE entity (
+		card_id TEXT PRIMARY KEY, dbf_id INTEGER, version INTEGER,
+		master_power TEXT, hero_power TEXT
+	);
+	CREATE TABLE tag (
+		card_id TEXT NOT NULL, tag INTEGER NOT NULL, value INTEGER NOT NULL,
+		PRIMARY KEY (card_id, tag)
+	) WITHOUT ROWID;
+	CREATE TABLE referenced_tag (
+		card_id TEXT NOT NULL, tag INTEGER NOT NULL, value INTEGER NOT NULL,
+		PRIMARY KEY (card_id, tag)
+	) WITHOUT ROWID;
+	CREATE TABLE string (
+		card_id TEXT NOT NULL, tag INTEGER NOT NULL, locale TEXT NOT NULL, text TEXT NOT NULL,
+		PRIMARY KEY (card_id, tag, locale)
+	) WITHOUT ROWID;
+	CREATE TABLE power (
+		card_id TEXT NOT NULL, power_index INTEGER NOT NULL, definition TEXT,
+		PRIMARY KEY (card_id, power_index)
+	) WITHOUT ROWID;
+	CREATE TABLE play_requirement (
+		card_id TEXT NOT NULL, power_index INTEGER NOT NULL, req_id INTEGER NOT NULL, param TEXT
+	);
+	CREATE TABLE entourage (
+		card_id TEXT NOT NULL, entourage_index INTEGER NOT NULL, entourage_id TEXT NOT NULL,
+		PRIMARY KEY (card_id, entourage_index)
+	) WITHOUT ROWID;
+	"""
+
+	# Created once all the rows are inserted
+	indexes = """
+	CREATE INDEX entity_dbf_id ON entity (dbf_id);
+	CREATE INDEX tag_value ON tag (tag, value);
+	CREATE INDEX referenced_tag_value ON referenced_tag (tag, value);
+	CREATE INDEX play_requirement_card_id ON play_requirement (card_id, power_index);
+	CREATE INDEX play_requirement_req_id ON play_requirement (req_id);
+	CREATE INDEX entourage_entourage_id ON entourage (entourage_id);
+	"""
+
+	tables = ("entity", "tag", "referenced_tag", "string", "power", "play_requirement", "entourage")
+
+	def __init__(self, path, build, batch_size=1000):
+		self.path = path
+		self.tmp_path = path + ".tmp"
+		if os.path.exists(self.tmp_path):
+			os.remove(self.tmp_path)
+		self.db = sqlite3.connect(self.tmp_path)
+		# The file is only moved in place once complete
+		self.db.execute("PRAGMA journal_mode = OFF")
+		self.db.execute("PRAGMA synchronous = OFF")
+		self.db.executescript(self.schema)
+		self.db.executemany("INSERT INTO metadata VALUES (?, ?)", [
+			("build", str(build)),
+			("hearthstone", str(getattr(hearthstone, "__version__", None))),
+		])
+		self.db.executemany(
+			"INSERT INTO game_tag VALUES (?, ?)",
+			[(int(tag), tag.name) for tag in GameTag]
+		)
+		self.batch_size = batch_size
+		self.rows = {table: [] for table in self.tables}
+		self.pending = 0
+
+	def write(self, entity):
+		id = entity.id
+		rows = self.rows
+		rows["entity"].append((
+			id, getattr(entity, "dbf_id", None), entity.version,
+			getattr(entity, "master_power", None), getattr(entity, "hero_power", None),
+		))
+		rows["tag"] += [(id, int(tag), value) for tag, value in entity.tags.items()]
+		rows["referenced_tag"] += [(id, int(tag), value) for tag, value in entity.referenced_tags.items()]
+		for tag, strings in entity.strings.items():
+			if isinstance(strings, str):
+				# Unlocalized STRING_TAGS
+				strings = {"enUS": strings}
+			rows["string"] += [(id, int(tag), locale, text) for locale, text in strings.items() if text]
+		for i, power in enumerate(entity.powers):
+			rows["power"].append((id, i, power.get("definition")))
+			for requirement in power.get("requirements", ()):
+				param = requirement.get("param")
+				rows["play_requirement"].append((
+					id, i, int(requirement["reqID"]), None if param is None else str(param)
+				))
+		rows["entourage"] += [(id, i, card_id) for i, card_id in enumerate(entity.entourage)]
+
+		self.pending += 1
+		if self.pending >= self.batch_size:
+			self.flush()
+
+	def flush(self):
+		for table, rows in self.rows.items():
+			if rows:
+				placeholders = ", ".join("?" * len(rows[0]))
+				self.db.executemany("INSERT INTO %s VALUES (%s)" % (table, placeholders), rows)
+				rows.clear()
+		self.pending = 0
+
+	def close(self):
+		self.flush()
+		self.db.executescript(self.indexes)
+		self.db.commit()
+		self.db.execute("ANALYZE")
+		self.db.close()
+		os.replace(self.tmp_path, self.path)
+
+
+def skip_locale(name, locales=None):
+	"""
+	Whether the TextAsset or locale \a name should not be loaded.
+	If \a locales is set, all the other locales are skipped.
+	"""
+	if name in IGNORE_LOCALES:
+		return True
+	return bool(locales) and name in Locale.__members__ and name not in locales
+
+
+class EntityRecord:
+	"""
+	Compact intermediate representation of an entity while the
+	bundles and DBFs are being read. It only becomes a full
+	cardxml.CardXML once the entity is about to be serialized.
+	"""
+	__slots__ = (
+		"id", "version", "dbf_id", "tags", "referenced_tags", "master_power",
+		"powers", "entourage", "triggered_power_history_info",
+	)
+
+	def __init__(self, id):
+		self.id = id
+		self.version = None
+		self.dbf_id = None
+		self.tags = {}
+		self.referenced_tags = {}
+		self.master_power = None
+		self.powers = []
+		self.entourage = []
+		self.triggered_power_history_info = []
+
+	def __repr__(self):
+		return "<%s: %s>" % (self.__class__.__name__, self.id)
+
+	def to_cardxml(self):
+		entity = cardxml.CardXML(self.id)
+		entity.version = self.version
+		if self.dbf_id is not None:
+			entity.dbf_id = self.dbf_id
+		entity.tags = self.tags
+		entity.referenced_tags = self.referenced_tags
+		if self.master_power is not None:
+			entity.master_power = self.master_power
+		entity.powers = self.powers
+		entity.entourage = self.entourage
+		entity.triggered_power_history_info = self.triggered_power_history_info
+		return entity
 
 
 def string_to_bool(s):
@@ -45,19 +532,229 @@ def detect_build(path):
 
 
 def guess_overload(text):
-	sre = re.search(r"Overload[^(]+\((\d+)\)", text)
+	sre = OVERLOAD_RE.search(text)
 	if sre is None:
 		return 0
 	return int(sre.groups()[0])
 
 
 def guess_spellpower(text):
-	sre = re.search(r"Spell (?:Power|Damage)(?:</b>)? \+(\d+)", text)
+	sre = SPELLPOWER_RE.search(text)
 	if sre is None:
 		return 0
 	return int(sre.groups()[0])
 
 
+class TagRule:
+	"""
+	Declarative rule deriving tags from an entity's description or id.
+	The rule is applied to entities where \a pattern matches \a field,
+	or, if \a condition is set, to all entities where condition(entity)
+	is true, in which case the match may be None.
+	\a apply(entity, match) returns a dict of tags to set, or a warning.
+	\a builds is the [min, max) range of builds the rule is used for.
+	"""
+	def __init__(self, name, field, pattern, apply, condition=None, builds=(None, None)):
+		self.name = name
+		self.field = field
+		self.pattern = pattern
+		self.regex = re.compile(pattern)
+		self.apply = apply
+		self.condition = condition
+		self.builds = builds
+
+	def __repr__(self):
+		return "<%s: %s>" % (self.__class__.__name__, self.name)
+
+	def for_build(self, build):
+		min_build, max_build = self.builds
+		if min_build is not None and build < min_build:
+			return False
+		if max_build is not None and build >= max_build:
+			return False
+		return True
+
+
+def _set_tags(*tags):
+	return lambda entity, match: {tag: True for tag in tags}
+
+
+def _apply_overload(entity, match):
+	assert entity.overload == 1
+	overload = int(match.group(1)) if match else 0
+	if not overload:
+		return "Could not guess overload for %r: %r" % (entity, entity.description)
+	return {GameTag.OVERLOAD: overload}
+
+
+def _apply_spellpower(entity, match):
+	assert entity.spell_damage == 1
+	sp = int(match.group(1)) if match else 0
+	if not sp:
+		return "Could not guess spell power for %r: %r" % (entity, entity.description)
+	return {GameTag.SPELLPOWER: sp}
+
+
+def _apply_missing_hero_power(entity, match):
+	assert not entity.tags.get(GameTag.HERO_POWER, 0)
+	return {GameTag.HERO_POWER: MISSING_HERO_POWERS[entity.id]}
+
+
+TAG_RULES = [
+	# Parse the exact overload amount
+	TagRule(
+		"overload", "description", OVERLOAD_RE.pattern, _apply_overload,
+		condition=lambda entity: entity.overload
+	),
+	# Parse the exact spellpower amount
+	TagRule(
+		"spellpower", "description", SPELLPOWER_RE.pattern, _apply_spellpower,
+		condition=lambda entity: entity.spell_damage
+	),
+	# Set the "shrouded" tags if available
+	TagRule(
+		"shrouded", "description", re.escape("Can't be targeted by Spells or Hero Powers."),
+		_set_tags(GameTag.CANT_BE_TARGETED_BY_SPELLS, GameTag.CANT_BE_TARGETED_BY_HERO_POWERS),
+		builds=(None, 6024)
+	),
+	TagRule(
+		"shrouded", "description", re.escape("Can't be targeted by spells or Hero Powers."),
+		_set_tags(GameTag.CANT_BE_TARGETED_BY_SPELLS, GameTag.CANT_BE_TARGETED_BY_HERO_POWERS),
+		builds=(6024, None)
+	),
+	# Set the CANT_ATTACK tag if available
+	TagRule(
+		"cant_attack", "description", r"Can't [aA]ttack\.", _set_tags(GameTag.CANT_ATTACK)
+	),
+	# Mark all spare parts with the SPARE_PART tag
+	TagRule("spare_part", "id", r"^PART_\d+", _set_tags(GameTag.SPARE_PART)),
+	TagRule(
+		"missing_hero_power", "id",
+		"^(?:%s)$" % ("|".join(re.escape(id) for id in sorted(MISSING_HERO_POWERS))),
+		_apply_missing_hero_power
+	),
+]
+
+
+class TagRuleEngine:
+	"""
+	Evaluates the TagRule objects for a build. The patterns of all the
+	rules on a field are compiled into a single regex, so that each field
+	is scanned once per entity whatever the number of rules.
+	Entities are evaluated one at a time, as they are cleaned, because
+	the entities reused from a base state are never cleaned again.
+	The number of matches per rule is kept by the engine, as the rules
+	are shared by all the builds. The single scan cannot tell which rule
+	the time goes to, so only the scan and apply totals are timed.
+	"""
+	def __init__(self, rules, build):
+		self.rules = [rule for rule in rules if rule.for_build(build)]
+		self.entities = 0
+		self.scan_time = 0.0
+		self.apply_time = 0.0
+		self.matches = {rule: 0 for rule in self.rules}
+		self.scanners = []
+		for field in sorted(set(rule.field for rule in self.rules)):
+			rules = [rule for rule in self.rules if rule.field == field]
+			# Lookaheads, so that matches of different rules may overlap
+			pattern = "|".join("(?=(?P<r%i>%s))" % (i, rule.pattern) for i, rule in enumerate(rules))
+			self.scanners.append((field, re.compile(pattern), rules))
+
+	def scan(self, entity):
+		"""
+		Return a dict of the first match of every rule in \a entity.
+		"""
+		ret = {}
+		for field, regex, rules in self.scanners:
+			text = getattr(entity, field) or ""
+			found = 0
+			for match in regex.finditer(text):
+				# The scanner only reports the first rule matching at a
+				# position, check whether the following ones match there too.
+				for rule in rules[int(match.lastgroup[1:]):]:
+					if rule not in ret:
+						rule_match = rule.regex.match(text, match.start())
+						if rule_match:
+							ret[rule] = rule_match
+							found += 1
+				if found == len(rules):
+					break
+		return ret
+
+	def evaluate(self, entity):
+		"""
+		Return (updates, warnings) for \a entity, where updates is the
+		dict of tags to set in rule order.
+		"""
+		updates = {}
+		warnings = []
+		start = time.perf_counter()
+		matches = self.scan(entity)
+		scanned = time.perf_counter()
+		for rule in self.rules:
+			match = matches.get(rule)
+			if rule.condition is not None:
+				if not rule.condition(entity):
+					continue
+			elif match is None:
+				continue
+
+			result = rule.apply(entity, match)
+			if isinstance(result, str):
+				warnings.append(result)
+			else:
+				self.matches[rule] += 1
+				updates.update(result)
+
+		self.entities += 1
+		self.scan_time += scanned - start
+		self.apply_time += time.perf_counter() - scanned
+		return updates, warnings
+
+	def report(self):
+		lines = ["Evaluated tag rules on %i entities: scanned in %.3fs, applied in %.3fs" % (
+			self.entities, self.scan_time, self.apply_time
+		)]
+		for rule in self.rules:
+			lines.append("Tag rule %r: %i matches" % (rule.name, self.matches[rule]))
+		return lines
+
+
+def _load_bundle(path, locales=None):
+	"""
+	Decode the bundle at \a path and return its asset's repr along
+	with the (name, script) pairs of all the wanted TextAssets in it.
+	"""
+	with open(path, "rb") as f:
+		bundle = unitypack.load(f)
+		asset = bundle.assets[0]
+		ret = []
+		for obj in asset.objects.values():
+			if obj.type == "TextAsset":
+				d = obj.read()
+				if not skip_locale(d.name, locales):
+					ret.append((d.name, d.script))
+	return repr(asset), ret
+
+
+def raw_locale(path):
+	return os.path.splitext(os.path.basename(path))[0]
+
+
+def _parse_text_asset(name, script):
+	processor = CardXMLProcessor()
+	processor.parse_text_asset(name, script)
+	replace = not script.startswith("<CardDefs>")
+	return processor.entities, processor.entity_strings, replace
+
+
+def _parse_raw(path):
+	processor = CardXMLProcessor()
+	with open(path, "rb") as f:
+		processor.parse_raw(f)
+	return processor.entities, processor.entity_strings, False
+
+
 class CardXMLProcessor:
 	unity3d_filenames = [
 		"cards.unity3d",
@@ -83,7 +780,31 @@ class CardXMLProcessor:
 		self._p.add_argument("--build", type=int, default=None)
 		self._p.add_argument("--dbf-dir", nargs="?", type=str)
 		self._p.add_argument("--manifest-csv", nargs="?", type=str)
+		self._p.add_argument("--no-dbf-cache", action="store_true")
+		self._p.add_argument(
+			"--base", nargs="?", type=str,
+			help="State saved by a previous run, to reuse its unchanged entities"
+		)
+		self._p.add_argument(
+			"--save-state", nargs="?", type=str,
+			help="Where to save the state of this run for a later --base"
+		)
 		self._p.add_argument("--raw", action="store_true")
+		self._p.add_argument("-j", "--jobs", type=int, default=1)
+		self._p.add_argument(
+			"--locales", nargs="+", type=str,
+			help="Only load these locales (enUS is always loaded)"
+		)
+		self._p.add_argument(
+			"--metrics", nargs="?", type=str,
+			help="Write the timings, counters and peak memory of the run to this file"
+		)
+		self._p.add_argument("--metrics-format", choices=("json", "prometheus"), default="json")
+		self._p.add_argument("--profile", nargs="?", type=str, help="Write a cProfile dump of the run to this file")
+		self._p.add_argument(
+			"--sqlite", "--db", nargs="?", type=str, dest="sqlite",
+			help="Also write the entities to this SQLite database"
+		)
 
 		# The final dict of entities
 		self.entities = {}
@@ -97,13 +818,22 @@ class CardXMLProcessor:
 		# Hero power dict
 		self.hero_powers = {}
 
-		# Localized strings
+		# Localized strings: card id -> tag -> locale -> text
 		self.entity_strings = {}
 
+		# Shared storage for the text of all localized strings
+		self.strings = StringTable()
+
+		# Locales to load, None for all of them
+		self.locales = None
+
+		self.metrics = Metrics()
+
 	def info(self, msg):
 		sys.stderr.write("[INFO] %s\n" % (msg))
 
 	def warn(self, msg):
+		self.metrics.count("warnings")
 		sys.stderr.write("[WARN] %s\n" % (msg))
 
 	def error(self, msg):
@@ -116,23 +846,78 @@ class CardXMLProcessor:
 			f.close()
 			return
 
-		bundle = unitypack.load(f)
-		asset = bundle.assets[0]
+		with self.metrics.span("load_bundle", file=os.path.basename(f.name)):
+			bundle = unitypack.load(f)
+			asset = bundle.assets[0]
 		self.info("Processing %r" % (asset))
 
 		for obj in asset.objects.values():
 			if obj.type == "TextAsset":
-				d = obj.read()
-				if d.name in IGNORE_LOCALES:
+				with self.metrics.span("read_text_asset"):
+					d = obj.read()
+				if skip_locale(d.name, self.locales):
 					continue
-				if d.script.startswith("<CardDefs>"):
-					xml = ElementTree.fromstring(d.script)
-					self.parse_full_carddefs(xml, d.name)
-				elif d.script.startswith("<?xml "):
-					xml = ElementTree.fromstring(d.script.encode("utf-8"))
-					self.parse_single_entity_xml(xml, d.name, locale=None)
-				else:
-					self.error("Bad TextAsset: %r" % (d))
+				self.parse_text_asset(d.name, d.script)
+
+	def parse_text_asset(self, name, script):
+		if script.startswith("<CardDefs>"):
+			with self.metrics.span("fromstring", locale=name):
+				xml = ElementTree.fromstring(script)
+			self.parse_full_carddefs(xml, name)
+		elif script.startswith("<?xml "):
+			# One asset per entity, timed together
+			with self.metrics.span("parse_entity_asset"):
+				xml = ElementTree.fromstring(script.encode("utf-8"))
+				self.parse_single_entity_xml(xml, name, locale=None)
+		else:
+			self.error("Bad TextAsset: %r" % (name))
+
+	def parse_files_parallel(self, files, jobs):
+		"""
+		Parse \a files in a pool of \a jobs processes.
+		Bundles are decoded and each locale is parsed in its own worker,
+		the results are then merged in the same order as a sequential run.
+		"""
+		self.info("Parsing %i files with %i jobs" % (len(files), jobs))
+		for f in files:
+			f.close()
+
+		with ProcessPoolExecutor(max_workers=jobs) as executor:
+			if self.args.raw:
+				paths = [f.name for f in files if not skip_locale(raw_locale(f.name), self.locales)]
+				results = executor.map(_parse_raw, paths)
+			else:
+				paths = [f.name for f in files if os.path.basename(f.name) in self.unity3d_filenames]
+				names, scripts = [], []
+				locales = [self.locales] * len(paths)
+				for asset, text_assets in executor.map(_load_bundle, paths, locales):
+					self.info("Processing %r" % (asset))
+					for name, script in text_assets:
+						names.append(name)
+						scripts.append(script)
+				results = executor.map(_parse_text_asset, names, scripts)
+
+			for entities, entity_strings, replace in results:
+				with self.metrics.span("merge"):
+					self.merge(entities, entity_strings, replace)
+
+	def merge(self, entities, entity_strings, replace=False):
+		"""
+		Merge entities and strings parsed by another processor.
+		Entities which are already known are kept (the first one seen wins)
+		unless \a replace is set, but their strings are always updated.
+		"""
+		for id, entity in entities.items():
+			if replace or id not in self.entities:
+				self.entities[id] = entity
+				self.entity_strings[id] = {}
+
+			for tag, strings in entity_strings[id].items():
+				d = self.entity_strings[id].setdefault(tag, {})
+				for locale, text in strings.items():
+					if self.locales and locale not in self.locales:
+						continue
+					d[sys.intern(locale)] = self.strings.add(text)
 
 	def parse_single_entity_xml(self, xml, id, locale=None):
 		"""
@@ -140,19 +925,22 @@ class CardXMLProcessor:
 		If the locale argument is set, read it as single-locale.
 		Otherwise, read it as merged-locales.
 		"""
-		entity = cardxml.CardXML(id)
+		entity = EntityRecord(id)
 		entity.version = int(xml.attrib["version"])
-		self.entity_strings[id] = {k: {} for k in entity.strings}
+		strings = self.entity_strings[id] = {}
 
 		for e in xml:
 			if e.tag == "Tag":
 				tag = GameTag(int(e.attrib["enumID"]))
 				if e.attrib["type"] == "String":
 					if locale:
-						self.entity_strings[id][tag][locale] = e.text
+						strings.setdefault(tag, {})[locale] = self.strings.add(e.text)
 					else:
 						for loc in e:
-							self.entity_strings[id][tag][loc.tag] = loc.text
+							if self.locales and loc.tag not in self.locales:
+								continue
+							text = self.strings.add(loc.text)
+							strings.setdefault(tag, {})[sys.intern(loc.tag)] = text
 				else:
 					value = int(e.attrib["value"])
 					entity.tags[tag] = value
@@ -187,22 +975,29 @@ class CardXMLProcessor:
 		self.entities[id] = entity
 
 	def parse_raw(self, f):
-		name = os.path.splitext(os.path.basename(f.name))[0]
-		xml = ElementTree.fromstring(f.read())
+		name = raw_locale(f.name)
+		if skip_locale(name, self.locales):
+			f.close()
+			return
+		with self.metrics.span("fromstring", locale=name):
+			xml = ElementTree.fromstring(f.read())
 		self.parse_full_carddefs(xml, name)
 
 	def parse_full_carddefs(self, xml, locale):
 		self.info("Reading full CardDefs file %r" % (locale))
+		locale = sys.intern(locale)
 
-		for entity_xml in xml.findall("Entity"):
-			id = entity_xml.attrib["CardID"]
-			if id not in self.entities:
-				self.parse_single_entity_xml(entity_xml, id, locale)
+		with self.metrics.span("parse_locale", locale=locale):
+			for entity_xml in xml.findall("Entity"):
+				id = entity_xml.attrib["CardID"]
+				if id not in self.entities:
+					self.parse_single_entity_xml(entity_xml, id, locale)
 
-			# Parse the entity's strings into self.entity_strings
-			for e in entity_xml.findall("Tag[@type='String']"):
-				tag = GameTag(int(e.attrib["enumID"]))
-				self.entity_strings[id][tag][locale] = e.text
+				# Parse the entity's strings into self.entity_strings
+				for e in entity_xml.findall("Tag[@type='String']"):
+					tag = GameTag(int(e.attrib["enumID"]))
+					text = self.strings.add(e.text)
+					self.entity_strings[id].setdefault(tag, {})[locale] = text
 
 	def parse_manifest_csv(self, path):
 		self.info("Processing manifest %r" % (path))
@@ -217,12 +1012,47 @@ class CardXMLProcessor:
 				else:
 					self.entities[card_id].dbf_id = dbf_id
 
+	def load_dbf_cached(self, path, load):
+		"""
+		Return load(path), using the binary index in the cache directory
+		next to the DBF directory if it was built from the same file.
+		"""
+		if self.args.no_dbf_cache:
+			with self.metrics.span("load_dbf", file=os.path.basename(path)):
+				return load(path)
+
+		dirname, filename = os.path.split(os.path.abspath(path))
+		cache_path = os.path.join(dirname + ".cache", filename + ".idx")
+		fingerprint = (DBF_CACHE_VERSION, file_fingerprint(path))
+		if os.path.exists(cache_path):
+			try:
+				with open(cache_path, "rb") as f:
+					cached_fingerprint, data = pickle.load(f)
+				if cached_fingerprint == fingerprint:
+					self.info("Using cached index %r" % (cache_path))
+					self.metrics.count("dbf_cache_hits")
+					return data
+			except Exception as e:
+				self.warn("Could not read DBF cache %r: %s" % (cache_path, e))
+
+		with self.metrics.span("load_dbf", file=os.path.basename(path)):
+			data = load(path)
+		try:
+			os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+			with open(cache_path + ".tmp", "wb") as f:
+				pickle.dump((fingerprint, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(cache_path + ".tmp", cache_path)
+		except OSError as e:
+			self.warn("Could not write DBF cache %r: %s" % (cache_path, e))
+		return data
+
 	def parse_card_dbf(self, path):
 		self.info("Processing CARD DBF %r" % (path))
-		dbf = Dbf.load(path)
+		dbf = self.load_dbf_cached(path, read_dbf)
 
 		# Whether we'll set the CARD_TAG dbf-style (post-15590) string tags
 		apply_locstrings = "NAME" in dbf.columns
+		self.metrics.count("card_rows", len(dbf.records))
 
 		for record in dbf.records:
 			id = record["ID"]
@@ -237,6 +1067,8 @@ class CardXMLProcessor:
 				self.entity_strings[card_id] = {}
 				for tag, column in self.tag_dbf_localized_columns:
 					r = record.get(column) or {}
+					if self.locales:
+						r = {k: v for k, v in r.items() if k in self.locales}
 					self.entity_strings[card_id][tag] = r
 
 				# Artist name is not localized in the new layout
@@ -256,30 +1088,123 @@ class CardXMLProcessor:
 
 	def parse_card_tag_dbf(self, path):
 		self.info("Processing CARD_TAG DBF %r" % (path))
-		dbf = Dbf.load(path)
-
-		for record in dbf.records:
-			dbf_id = record["CARD_ID"]
+		table = self.load_dbf_cached(path, CardTagTable.from_dbf)
+		self.metrics.count("tag_rows", len(table))
+		for card_id, tag, value in table.skipped:
+			self.warn("Skipping CARD_TAG.xml record with missing values: CARD_ID=%r, TAG_ID=%r, TAG_VALUE=%r" % (
+				card_id, tag, value
+			))
+
+		for dbf_id, rows in table.groupby_card():
 			card_id = self.dbf_ids[dbf_id]
-			tag = record["TAG_ID"]
-			value = record["TAG_VALUE"]
-			is_reference = record["IS_REFERENCE_TAG"]
-			# ispower = record["IS_POWER_KEYWORD_TAG"]
 			if card_id not in self.entities:
 				self.warn("Entity %r not found in card defs but present in CARD_TAG.xml" % (card_id))
-			elif is_reference:
-				self.entities[card_id].referenced_tags[tag] = value
-			else:
-				self.entities[card_id].tags[tag] = value
+				continue
+
+			entity = self.entities[card_id]
+			for tag, value, is_reference in rows:
+				if is_reference:
+					entity.referenced_tags[tag] = value
+				else:
+					entity.tags[tag] = value
+
+	def entity_fingerprint(self, record):
+		"""
+		Hash everything that clean_entity() and to_xml() read for \a record,
+		so that an unchanged fingerprint means unchanged output.
+		"""
+		strings = self.entity_strings.get(record.id, {})
+		hero_power = record.tags.get(GameTag.HERO_POWER) or MISSING_HERO_POWERS.get(record.id)
+		data = (
+			STATE_VERSION, getattr(hearthstone, "__version__", None),
+			# Build-dependent branches in clean_entity()
+			self.build < 3640, self.build < 6024,
+			record.id, record.version, record.dbf_id,
+			sorted(record.tags.items()), sorted(record.referenced_tags.items()),
+			record.master_power, record.powers, record.entourage,
+			record.triggered_power_history_info,
+			sorted((tag, sorted(texts.items())) for tag, texts in strings.items()),
+			self.dbf_ids.get(hero_power),
+			[self.guids.get(entourage) for entourage in record.entourage],
+		)
+		return hashlib.sha1(repr(data).encode("utf-8")).digest()
+
+	def load_state(self, path):
+		self.info("Loading base state %r" % (path))
+		with open(path, "rb") as f:
+			version, entities = pickle.load(f)
+		if version != STATE_VERSION:
+			self.warn("Ignoring base state %r (version %r)" % (path, version))
+			return {}
+		return entities
+
+	def save_state(self, path, state):
+		self.info("Saving state to %r" % (path))
+		with open(path + ".tmp", "wb") as f:
+			pickle.dump((STATE_VERSION, state), f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(path + ".tmp", path)
+
+	def make_entity(self, record):
+		with self.metrics.span("clean_entity"):
+			entity = record.to_cardxml()
+			self.clean_entity(entity)
+		return entity
 
-	def generate_xml(self):
+	def generate_xml(self, f):
 		self.info("Processing %i entities" % (len(self.entities)))
-		root = ElementTree.Element("CardDefs", build=str(self.build))
+		base = self.load_state(self.args.base) if self.args.base else {}
+		save_state = self.args.save_state
+		state = {}
+		reused = 0
+
+		db = None
+		if self.args.sqlite:
+			self.info("Writing database to %r" % (self.args.sqlite))
+			db = CardDB(self.args.sqlite, self.build)
+
+		writer = PrettyXMLWriter(f, "CardDefs", build=str(self.build))
 		ids = sorted(self.entities.keys(), key=str.lower)
+		span = self.metrics.span
 		for id in ids:
-			root.append(self.entities[id].to_xml())
-
-		return pretty_xml(root)
+			record = self.entities[id]
+			entity = None
+			if base or save_state:
+				with span("fingerprint"):
+					fingerprint = self.entity_fingerprint(record)
+				cached = base.get(id)
+				if cached and cached[0] == fingerprint:
+					data = cached[1]
+					reused += 1
+				else:
+					entity = self.make_entity(record)
+					with span("pretty_xml"):
+						data = writer.serialize(entity.to_xml())
+				if save_state:
+					state[id] = (fingerprint, data)
+				writer.write_raw(data)
+			else:
+				entity = self.make_entity(record)
+				with span("pretty_xml"):
+					writer.write(entity.to_xml())
+
+			if db:
+				# Reused entities only exist as XML, the database needs them whole
+				if entity is None:
+					entity = self.make_entity(record)
+				with span("sqlite"):
+					db.write(entity)
+		writer.close()
+
+		if db:
+			with self.metrics.span("sqlite"):
+				db.close()
+
+		self.metrics.count("entities", len(ids))
+		if base:
+			self.info("Reused %i of %i entities from the base state" % (reused, len(ids)))
+			self.metrics.count("reused_entities", reused)
+		if save_state:
+			self.save_state(save_state, state)
 
 	def clean_entity(self, entity):
 		# Update entity strings from self.entity_strings
@@ -287,7 +1212,7 @@ class CardXMLProcessor:
 			for tag in cardxml.STRING_TAGS:
 				s = self.entity_strings[entity.id].pop(tag, {})
 				if "enUS" in s:
-					entity.strings[tag] = s["enUS"].replace("\\n", "\n").strip()
+					entity.strings[tag] = self.strings.normalize(s["enUS"])
 
 			for tag, strings in self.entity_strings[entity.id].items():
 				for locale, text in strings.items():
@@ -299,50 +1224,15 @@ class CardXMLProcessor:
 						if text == self.entity_strings[entity.id][tag].get("enUS", ""):
 							continue
 
-					text = text.replace("\\n", "\n").strip()
+					text = self.strings.normalize(text)
 					if text:
 						entity.strings[tag][locale] = text
 
-		description = entity.description
-
-		# Parse the exact overload amount
-		if entity.overload:
-			assert entity.overload == 1
-			overload = guess_overload(description)
-			if not overload:
-				self.warn("Could not guess overload for %r: %r" % (entity, description))
-			else:
-				entity.tags[GameTag.OVERLOAD] = overload
-
-		# Parse the exact spellpower amount
-		if entity.spell_damage:
-			assert entity.spell_damage == 1
-			sp = guess_spellpower(description)
-			if not sp:
-				self.warn("Could not guess spell power for %r: %r" % (entity, description))
-			else:
-				entity.tags[GameTag.SPELLPOWER] = sp
-
-		# Set the "shrouded" tags if available
-		if self.build < 6024:
-			SHROUDED = "Can't be targeted by Spells or Hero Powers."
-		else:
-			SHROUDED = "Can't be targeted by spells or Hero Powers."
-		if SHROUDED in description:
-			entity.tags[GameTag.CANT_BE_TARGETED_BY_SPELLS] = True
-			entity.tags[GameTag.CANT_BE_TARGETED_BY_HERO_POWERS] = True
-
-		# Set the CANT_ATTACK tag if available
-		if "Can't attack." in description or "Can't Attack." in description:
-			entity.tags[GameTag.CANT_ATTACK] = True
-
-		# Mark all spare parts with the SPARE_PART tag
-		if SPARE_PART_RE.match(entity.id):
-			entity.tags[GameTag.SPARE_PART] = True
-
-		if entity.id in MISSING_HERO_POWERS:
-			assert not entity.tags.get(GameTag.HERO_POWER, 0)
-			entity.tags[GameTag.HERO_POWER] = MISSING_HERO_POWERS[entity.id]
+		# Set the tags guessed from the description and the card id
+		updates, warnings = self.tag_rules.evaluate(entity)
+		for warning in warnings:
+			self.warn(warning)
+		entity.tags.update(updates)
 
 		# Set the hero power cardIDs
 		hero_power = entity.tags.get(GameTag.HERO_POWER, 0)
@@ -360,42 +1250,84 @@ class CardXMLProcessor:
 	def run(self, args):
 		self.args = self._p.parse_args(args)
 
+		if self.args.profile:
+			profiler = cProfile.Profile()
+			profiler.runcall(self.process)
+			self.info("Writing profile to %r" % (self.args.profile))
+			profiler.dump_stats(self.args.profile)
+		else:
+			self.process()
+
+		self.info("Processed build %r in %.2fs, peak RSS %.1f MB" % (
+			self.build, time.perf_counter() - self.metrics.start, Metrics.peak_rss() / (1024 * 1024)
+		))
+		if self.args.metrics:
+			self.write_metrics(self.args.metrics, self.args.metrics_format)
+
+	def write_metrics(self, path, format):
+		self.info("Writing metrics to %r" % (path))
+		self.metrics.count("strings", len(self.strings))
+		for rule in self.tag_rules.rules:
+			self.metrics.count("tag_rule_%s_matches" % (rule.name), self.tag_rules.matches[rule])
+		self.metrics.add_span("tag_rule_scan", self.tag_rules.scan_time, count=self.tag_rules.entities)
+		self.metrics.add_span("tag_rule_apply", self.tag_rules.apply_time, count=self.tag_rules.entities)
+
+		info = {"build": self.build, "jobs": self.args.jobs}
+		with open(path, "w") as f:
+			if format == "prometheus":
+				self.metrics.write_prometheus(f, **info)
+			else:
+				self.metrics.write_json(f, **info)
+
+	def process(self):
 		self.build = self.args.build or detect_build(self.args.files[0].name)
 		if self.build is None:
 			self.error("Could not detect build. Use --build.")
 
-		for f in self.args.files:
-			if self.args.raw:
-				self.parse_raw(f)
+		self.tag_rules = TagRuleEngine(TAG_RULES, self.build)
+
+		if self.args.locales:
+			# enUS is needed for the descriptions the tags are guessed from
+			self.locales = set(self.args.locales) | {"enUS"}
+
+		with self.metrics.span("parse"):
+			if self.args.jobs > 1:
+				self.parse_files_parallel(self.args.files, self.args.jobs)
 			else:
-				self.parse_bundle(f)
+				for f in self.args.files:
+					if self.args.raw:
+						self.parse_raw(f)
+					else:
+						self.parse_bundle(f)
 
 		if self.args.manifest_csv:
-			self.parse_manifest_csv(self.args.manifest_csv)
+			with self.metrics.span("manifest_csv"):
+				self.parse_manifest_csv(self.args.manifest_csv)
 
 		if self.args.dbf_dir:
 			path = os.path.join(self.args.dbf_dir, "CARD.xml")
 			if os.path.exists(path):
-				self.parse_card_dbf(path)
+				with self.metrics.span("card_dbf"):
+					self.parse_card_dbf(path)
 
 			# Check for CARD_TAG.xml too
 			path = os.path.join(self.args.dbf_dir, "CARD_TAG.xml")
 			if os.path.exists(path):
-				self.parse_card_tag_dbf(path)
+				with self.metrics.span("card_tag_dbf"):
+					self.parse_card_tag_dbf(path)
 
 		if not self.dbf_ids:
 			self.warn("No DBF database found. Specify one with --dbf-dir or --manifest-csv.")
 
-		for entity in self.entities.values():
-			self.clean_entity(entity)
-
-		xml = self.generate_xml()
+		with self.metrics.span("generate_xml"):
+			if self.args.outfile:
+				self.info("Writing to %r" % (self.args.outfile.name))
+				self.generate_xml(self.args.outfile)
+			else:
+				self.generate_xml(sys.stdout.buffer)
 
-		if self.args.outfile:
-			self.info("Writing to %r" % (self.args.outfile.name))
-			self.args.outfile.write(xml)
-		else:
-			sys.stdout.write(xml.decode("utf-8"))
+		for line in self.tag_rules.report():
+			self.info(line)
 
 
 def main():
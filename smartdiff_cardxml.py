@@ -1,6 +1,105 @@
 #!/usr/bin/env python
+import hashlib
+import json
+import os
+import pickle
+import subprocess
 import sys
-from hearthstone.cardxml import load as load_cardxml
+from argparse import ArgumentParser
+from collections import OrderedDict
+from enum import Enum
+from xml.etree import ElementTree
+import hearthstone
+from hearthstone.cardxml import CardXML, load as load_cardxml
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "smartdiff_cardxml")
+
+
+def load_cardxml_data(data, locale="enUS"):
+	"""
+	Same as hearthstone.cardxml.load(), from the contents of the XML
+	file instead of its path.
+	"""
+	db = {}
+	xml = ElementTree.fromstring(data)
+	for carddata in xml.findall("Entity"):
+		card = CardXML.from_xml(carddata)
+		card.locale = locale
+		db[card.id] = card
+	return db, xml
+
+
+class GitBlobReader:
+	"""
+	Reads blobs from the git repository at \a repo through a single
+	long-lived `git cat-file --batch` process.
+	"""
+	def __init__(self, repo):
+		self.repo = repo
+		self.process = subprocess.Popen(
+			["git", "-C", repo, "cat-file", "--batch"],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE
+		)
+
+	def read(self, rev):
+		"""
+		Return the (sha, data) of the object named \a rev, which may be
+		any git object name such as "15590:CardDefs.xml".
+		"""
+		self.process.stdin.write(rev.encode("utf-8") + b"\n")
+		self.process.stdin.flush()
+		header = self.process.stdout.readline().decode("utf-8").split()
+		if len(header) != 3:
+			raise KeyError("%s: %r not found" % (self.repo, rev))
+		sha, type, size = header
+		data = self.process.stdout.read(int(size))
+		# Each object is followed by a newline
+		self.process.stdout.read(1)
+		return sha, data
+
+	def close(self):
+		self.process.stdin.close()
+		self.process.wait()
+
+
+def git_tags(repo):
+	"""
+	Return a dict of commit sha -> tag name for every tag in \a repo.
+	"""
+	out = subprocess.check_output([
+		"git", "-C", repo, "for-each-ref", "--sort=refname",
+		"--format=%(objectname) %(*objectname) %(refname:short)", "refs/tags",
+	]).decode("utf-8")
+	ret = {}
+	for line in out.splitlines():
+		sha, commit, name = line.split(" ")
+		# Annotated tags point to the tag object, dereference them
+		ret.setdefault(commit or sha, name)
+	return ret
+
+
+def expand_revisions(repo, revisions):
+	"""
+	Expand the "A..B" ranges in \a revisions to A followed by every
+	tagged commit after it up to B, oldest first. Other revisions are
+	returned as-is.
+	"""
+	tags = None
+	ret = []
+	for rev in revisions:
+		if ".." not in rev:
+			ret.append(rev)
+			continue
+		start, end = rev.split("..", 1)
+		if tags is None:
+			tags = git_tags(repo)
+		commits = subprocess.check_output([
+			"git", "-C", repo, "rev-list", "--reverse", "--first-parent", rev
+		]).decode("utf-8").split()
+		ret.append(start)
+		ret += [tags[commit] for commit in commits if commit in tags]
+	return ret
 
 
 def card_diff(first, other):
@@ -41,15 +140,141 @@ def card_diff(first, other):
 	return ret
 
 
+def card_fingerprint(card):
+	"""
+	Summary of everything card_diff() compares. Two cards with equal
+	fingerprints have an empty diff.
+	"""
+	return (
+		frozenset(card.tags.items()),
+		frozenset(card.requirements.items()),
+		card.hero_power,
+		tuple(card.entourage),
+	)
+
+
+class CardIndex:
+	"""
+	Index of a card database, built in a single pass: the fingerprint
+	of every card along with the inventories of the tags, referenced
+	tags and play requirements used by any card.
+	"""
+	def __init__(self, cards):
+		self.cards = cards
+		self.fingerprints = {}
+		self.tags = set()
+		self.referenced_tags = set()
+		self.requirements = set()
+
+		for id, card in cards.items():
+			self.fingerprints[id] = card_fingerprint(card)
+			self.tags.update(card.tags)
+			self.referenced_tags.update(card.referenced_tags)
+			self.requirements.update(card.requirements)
+
+	def changed(self, other):
+		"""
+		Yield the ids of the cards present in both indexes whose
+		fingerprint differs.
+		"""
+		for id, fingerprint in self.fingerprints.items():
+			other_fingerprint = other.fingerprints.get(id)
+			if other_fingerprint is not None and other_fingerprint != fingerprint:
+				yield id
+
+
+class CardDefsCache:
+	"""
+	Cache of parsed CardDefs, keyed by the SHA-1 of the XML file and the
+	versions of the cache format and of the hearthstone library, as the
+	pickled cards do not get the attributes added by newer versions.
+	Only the databases of the pair being compared are kept in memory.
+	They are pickled to \a path for later runs, evicting the least
+	recently used files once they take more than \a max_size bytes.
+	"""
+	# The old and new CardDefs of a report
+	MEMORY_SIZE = 2
+
+	# Bump when the pickled data changes
+	CACHE_VERSION = 1
+
+	def __init__(self, path, max_size):
+		self.path = path
+		self.max_size = max_size
+		self.indexes = OrderedDict()
+
+	def _cache_path(self, digest):
+		version = getattr(hearthstone, "__version__", "unknown")
+		return os.path.join(self.path, "%s-%i-%s.pickle" % (digest, self.CACHE_VERSION, version))
+
+	def load(self, path):
+		"""
+		Return the CardIndex for the CardDefs.xml at \a path.
+		"""
+		sha1 = hashlib.sha1()
+		with open(path, "rb") as f:
+			for chunk in iter(lambda: f.read(1024 * 1024), b""):
+				sha1.update(chunk)
+		return self._index(sha1.hexdigest(), lambda: load_cardxml(path)[0])
+
+	def load_data(self, data):
+		"""
+		Return the CardIndex for the CardDefs.xml contents \a data.
+		"""
+		return self._index(hashlib.sha1(data).hexdigest(), lambda: load_cardxml_data(data)[0])
+
+	def _index(self, digest, parse):
+		if digest in self.indexes:
+			self.indexes.move_to_end(digest)
+			return self.indexes[digest]
+		index = self.indexes[digest] = CardIndex(self._load_cards(digest, parse))
+		while len(self.indexes) > self.MEMORY_SIZE:
+			self.indexes.popitem(last=False)
+		return index
+
+	def _load_cards(self, digest, parse):
+		cache_path = self._cache_path(digest)
+		if os.path.exists(cache_path):
+			try:
+				with open(cache_path, "rb") as f:
+					cards = pickle.load(f)
+				# Mark as recently used
+				os.utime(cache_path)
+				return cards
+			except Exception:
+				os.remove(cache_path)
+
+		cards = parse()
+		try:
+			os.makedirs(self.path, exist_ok=True)
+			with open(cache_path + ".tmp", "wb") as f:
+				pickle.dump(cards, f, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(cache_path + ".tmp", cache_path)
+			self.evict()
+		except OSError as e:
+			# The cache is optional, eg. when it is read-only or full
+			sys.stderr.write("[WARN] Could not write to the cache in %r: %s\n" % (self.path, e))
+			if os.path.exists(cache_path + ".tmp"):
+				os.remove(cache_path + ".tmp")
+		return cards
+
+	def evict(self):
+		entries = []
+		for filename in os.listdir(self.path):
+			if filename.endswith(".pickle"):
+				st = os.stat(os.path.join(self.path, filename))
+				entries.append((st.st_mtime, st.st_size, filename))
+
+		total = sum(size for mtime, size, filename in entries)
+		for mtime, size, filename in sorted(entries):
+			if total <= self.max_size:
+				break
+			os.remove(os.path.join(self.path, filename))
+			total -= size
+
+
 def get_new_values(attr, first, other):
-	def get_values(cards):
-		ret = set()
-		for card in cards:
-			for value in getattr(card, attr):
-				ret.add(value)
-		return ret
-
-	old, new = get_values(first.values()), get_values(other.values())
+	old, new = getattr(first, attr), getattr(other, attr)
 	return [k for k in new if k not in old]
 
 
@@ -61,45 +286,46 @@ def get_tags(cards):
 	return ret
 
 
-def print_enum_diff(key, before, after):
+def print_enum_diff(key, before, after, file=None):
 	if before is None:
-		print("  - ADDED %s = %r" % (key, after))
+		print("  - ADDED %s = %r" % (key, after), file=file)
 	elif after is None:
 		if not before or not after:
 			return
-		print("  - DELETED %s (was: %r)" % (key, before))
+		print("  - DELETED %s (was: %r)" % (key, before), file=file)
 	else:
-		print("  - CHANGED %s: %r -> %r" % (key, before, after))
+		print("  - CHANGED %s: %r -> %r" % (key, before, after), file=file)
 
 
-def print_report(old_path, new_path):
-	print("OLD: %s" % (old_path))
-	print("NEW: %s\n" % (new_path))
+def diff_records(old_path, new_path, first_index, other_index):
+	"""
+	Yield the diff between two CardIndex objects as a stream of records
+	(dicts with a "type" key), in the order of the text report.
+	"""
+	yield {"type": "report", "old": old_path, "new": new_path}
 
-	first, first_xml = load_cardxml(old_path)
-	other, other_xml = load_cardxml(new_path)
+	first, other = first_index.cards, other_index.cards
 	new_cards = {k: v for k, v in other.items() if k not in first}
 	deleted_cards = {k: v for k, v in first.items() if k not in other}
 
 	if new_cards:
-		print("%i new cards:" % (len(new_cards)))
+		yield {"type": "section", "section": "new_cards", "count": len(new_cards)}
 		for id, card in sorted(new_cards.items()):
-			print("* %r (%s): %s, %s - %r" % (card.name, id, card.card_set, card.type, card.description))
-		print()
+			yield {
+				"type": "new_card", "id": id, "name": card.name, "card_set": card.card_set,
+				"card_type": card.type, "description": card.description,
+			}
 
 	if deleted_cards:
-		print("%i deleted cards:" % (len(deleted_cards)))
+		yield {"type": "section", "section": "deleted_cards", "count": len(deleted_cards)}
 		for id, card in sorted(deleted_cards.items()):
-			print("* %r (%s)" % (card.name, id))
-		print()
+			yield {"type": "deleted_card", "id": id, "name": card.name}
 
 	changed_cards = {}
 	text_changes = {}
-	# Find changed cards
-	for id, card in first.items():
-		if id in deleted_cards:
-			# Skip over deleted cards
-			continue
+	# Find changed cards, only diffing the ones whose fingerprint changed
+	for id in first_index.changed(other_index):
+		card = first[id]
 		diff = card_diff(card, other[id])
 		if diff["text"]:
 			text_changes[card] = diff.pop("text")
@@ -108,66 +334,223 @@ def print_report(old_path, new_path):
 
 	if text_changes:
 		text_changes = sorted(text_changes.items(), key=lambda t: t[0].id)
-		print("%i text changes" % (len(text_changes)))
-
+		yield {"type": "section", "section": "text_changes", "count": len(text_changes)}
 		for card, diff in text_changes:
-			print("* %s (%s)" % (card.name, card.id))
-			for tag, value in diff.items():
-				print_enum_diff(tag, *value)
-		print()
+			yield {
+				"type": "text_change", "id": card.id, "name": card.name,
+				"changes": [(tag, ) + value for tag, value in diff.items()],
+			}
 
 	if changed_cards:
 		changed_cards = sorted(changed_cards.items(), key=lambda t: t[0].id)
-		print("%i changed cards:" % (len(changed_cards)))
+		yield {"type": "section", "section": "changed_cards", "count": len(changed_cards)}
 		for card, diff in changed_cards:
-			print("* %s (%s)" % (card.name, card.id))
-			for tag, value in diff["tags"].items():
-				print_enum_diff(tag, *value)
-
-			for pr, value in diff["play_requirements"].items():
-				print_enum_diff(pr, *value)
-
-			if diff["hero_power"]:
-				print("  - UPDATED HERO POWER: %r -> %r" % diff["hero_power"])
-
+			entourage = None
 			if diff["entourage"]:
 				added, removed = diff["entourage"]
-				print("  - UPDATED ENTOURAGE:")
-				if added:
-					print("    * ADDED: %s" % (", ".join(repr(other.get(id, id)) for id in added)))
-				if removed:
-					print("    * REMOVED: %s" % (", ".join(repr(first.get(id, id)) for id in removed)))
-		print()
+				entourage = {"added": added, "removed": removed}
+			yield {
+				"type": "changed_card", "id": card.id, "name": card.name,
+				"tags": [(tag, ) + value for tag, value in diff["tags"].items()],
+				"play_requirements": [(pr, ) + value for pr, value in diff["play_requirements"].items()],
+				"hero_power": diff["hero_power"] or None,
+				"entourage": entourage,
+			}
+
+	for attr in ("tags", "referenced_tags", "requirements"):
+		values = get_new_values(attr, first_index, other_index)
+		if values:
+			yield {"type": "new_values", "section": attr, "values": values}
+
+
+def _jsonable(value):
+	if isinstance(value, Enum):
+		return value.name
+	if isinstance(value, (list, tuple)):
+		return [_jsonable(v) for v in value]
+	if isinstance(value, dict):
+		return {k: _jsonable(v) for k, v in value.items()}
+	return value
+
+
+class JSONLinesWriter:
+	"""
+	Writes every record as a line of JSON, enums by name.
+	"""
+	def __init__(self, f):
+		self.f = f
+
+	def write(self, record):
+		self.f.write(json.dumps(_jsonable(record), sort_keys=True) + "\n")
+
+	def close(self):
+		self.f.flush()
+
+
+class TextReportWriter:
+	"""
+	Renders the records of a single report as the human-readable smartdiff.
+	"""
+	section_headers = {
+		"new_cards": "%i new cards:",
+		"deleted_cards": "%i deleted cards:",
+		"text_changes": "%i text changes",
+		"changed_cards": "%i changed cards:",
+	}
 
-	new_tags = get_new_values("tags", first, other)
-	if new_tags:
-		print("%i new GameTag:" % (len(new_tags)))
-		print(", ".join(repr(tag) for tag in new_tags))
-		print()
+	new_values_headers = {
+		"tags": "%i new GameTag:",
+		"referenced_tags": "%i new Referenced Tags:",
+		"requirements": "%i new PlayReq:",
+	}
 
-	new_reftags = get_new_values("referenced_tags", first, other)
-	if new_reftags:
-		print("%i new Referenced Tags:" % (len(new_reftags)))
-		print(", ".join(repr(tag) for tag in new_reftags))
-		print()
+	def __init__(self, f, first, other):
+		self.f = f
+		self.first = first
+		self.other = other
+		self.in_section = False
+
+	def print(self, *args):
+		print(*args, file=self.f)
+
+	def end_section(self):
+		if self.in_section:
+			self.print()
+			self.in_section = False
+
+	def write(self, record):
+		type = record["type"]
+		if type == "report":
+			self.print("OLD: %s" % (record["old"]))
+			self.print("NEW: %s\n" % (record["new"]))
+		elif type == "section":
+			self.end_section()
+			self.print(self.section_headers[record["section"]] % (record["count"]))
+			self.in_section = True
+		elif type == "new_card":
+			self.print("* %r (%s): %s, %s - %r" % (
+				record["name"], record["id"], record["card_set"], record["card_type"],
+				record["description"]
+			))
+		elif type == "deleted_card":
+			self.print("* %r (%s)" % (record["name"], record["id"]))
+		elif type == "text_change":
+			self.print("* %s (%s)" % (record["name"], record["id"]))
+			for tag, before, after in record["changes"]:
+				print_enum_diff(tag, before, after, file=self.f)
+		elif type == "changed_card":
+			self.print("* %s (%s)" % (record["name"], record["id"]))
+			for tag, before, after in record["tags"]:
+				print_enum_diff(tag, before, after, file=self.f)
+
+			for pr, before, after in record["play_requirements"]:
+				print_enum_diff(pr, before, after, file=self.f)
+
+			if record["hero_power"]:
+				self.print("  - UPDATED HERO POWER: %r -> %r" % tuple(record["hero_power"]))
+
+			if record["entourage"]:
+				added, removed = record["entourage"]["added"], record["entourage"]["removed"]
+				self.print("  - UPDATED ENTOURAGE:")
+				if added:
+					self.print("    * ADDED: %s" % (", ".join(repr(self.other.get(id, id)) for id in added)))
+				if removed:
+					self.print("    * REMOVED: %s" % (", ".join(repr(self.first.get(id, id)) for id in removed)))
+		elif type == "new_values":
+			self.end_section()
+			values = record["values"]
+			self.print(self.new_values_headers[record["section"]] % (len(values)))
+			self.print(", ".join(repr(value) for value in values))
+			self.print()
+		else:
+			raise NotImplementedError("Unknown record type: %r" % (type))
+
+	def close(self):
+		self.end_section()
+
+
+def print_report(old_path, new_path, cache=None, format="text", f=sys.stdout):
+	if cache:
+		first_index, other_index = cache.load(old_path), cache.load(new_path)
+	else:
+		first_index = CardIndex(load_cardxml(old_path)[0])
+		other_index = CardIndex(load_cardxml(new_path)[0])
+
+	write_report(old_path, new_path, first_index, other_index, format, f)
+
+
+def print_git_reports(repo, revisions, path="CardDefs.xml", cache=None, format="text", f=sys.stdout):
+	"""
+	Print a report for every consecutive pair of \a revisions of the
+	file at \a path in the git repository \a repo.
+	"""
+	reader = GitBlobReader(repo)
+	indexes = {}
+	try:
+		previous = None
+		for rev in revisions:
+			sha, data = reader.read("%s:%s" % (rev, path))
+			if cache:
+				index = cache.load_data(data)
+			else:
+				# Consecutive identical blobs are only parsed once
+				if sha not in indexes:
+					indexes = {sha: CardIndex(load_cardxml_data(data)[0])}
+				index = indexes[sha]
+			if previous is not None:
+				write_report(previous[0], rev, previous[1], index, format, f)
+			previous = rev, index
+	finally:
+		reader.close()
+
+
+def write_report(old_path, new_path, first_index, other_index, format="text", f=sys.stdout):
+	if format == "json":
+		writer = JSONLinesWriter(f)
+	else:
+		writer = TextReportWriter(f, first_index.cards, other_index.cards)
 
-	new_playreqs = get_new_values("requirements", first, other)
-	if new_playreqs:
-		print("%i new PlayReq:" % (len(new_playreqs)))
-		print(", ".join(repr(pr) for pr in new_playreqs))
-		print()
+	for record in diff_records(old_path, new_path, first_index, other_index):
+		writer.write(record)
+	writer.close()
 
 
 def main():
-	args = sys.argv[1:]
-	if len(args) < 2:
-		raise ValueError("Need at least two arguments")
-
-	if len(args) == 2:
-		print_report(args[0], args[1])
-	else:
-		for old, new in zip(args, args[1:]):
-			print_report(old, new)
+	p = ArgumentParser()
+	p.add_argument(
+		"files", nargs="+",
+		help="CardDefs.xml files, or revisions and A..B ranges with --repo, from oldest to newest"
+	)
+	p.add_argument("--repo", type=str, help="Read the CardDefs from this git repository")
+	p.add_argument("--path", type=str, default="CardDefs.xml", help="Path of the CardDefs in --repo")
+	p.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR)
+	p.add_argument(
+		"--cache-size", type=int, default=2048,
+		help="Maximum size of the parsed CardDefs cache, in MB"
+	)
+	p.add_argument("--no-cache", action="store_true")
+	p.add_argument(
+		"--format", choices=("text", "json"), default="text",
+		help="Human-readable report, or JSON Lines records"
+	)
+	args = p.parse_args()
+
+	files = args.files
+	if args.repo:
+		files = expand_revisions(args.repo, files)
+	if len(files) < 2:
+		p.error("Need at least two files")
+
+	cache = None
+	if not args.no_cache:
+		cache = CardDefsCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+	if args.repo:
+		print_git_reports(args.repo, files, args.path, cache, args.format)
+		return
+
+	for old, new in zip(files, files[1:]):
+		print_report(old, new, cache, args.format)
 
 
 if __name__ == "__main__":
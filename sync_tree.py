@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Copies a build directory into a repository like `cp -rf SRC/* DEST`,
+but only writes the files whose content changed. Destination files
+matching the --delete patterns are deleted when they are not in the
+source any more.
+"""
+import fnmatch
+import os
+import shutil
+from argparse import ArgumentParser
+from commit_history import BUILDDIR, HashCache
+
+
+def is_managed(path, patterns):
+	"""
+	Whether \a path is matched by one of \a patterns or is inside a
+	directory matched by one of them, as with `rm -rf PATTERN`.
+	"""
+	parts = path.split("/")
+	for pattern in patterns:
+		pattern_parts = pattern.split("/")
+		if len(parts) >= len(pattern_parts) and all(
+			fnmatch.fnmatchcase(part, pattern_part) for part, pattern_part in zip(parts, pattern_parts)
+		):
+			return True
+	return False
+
+
+def list_files(root, skip_hidden=False):
+	"""
+	Return the relative paths of the files in \a root, skipping the
+	top-level entries starting with a dot if \a skip_hidden is set
+	and the .git directory.
+	"""
+	ret = []
+	for dirpath, dirs, files in os.walk(root):
+		rel = os.path.relpath(dirpath, root)
+		if rel == ".":
+			rel = ""
+			dirs[:] = [d for d in dirs if d != ".git" and not (skip_hidden and d.startswith("."))]
+			if skip_hidden:
+				files = [f for f in files if not f.startswith(".")]
+		for filename in files:
+			ret.append(os.path.join(rel, filename).replace(os.sep, "/"))
+	return ret
+
+
+class TreeSync:
+	def __init__(self, hash_cache):
+		self.hash_cache = hash_cache
+		self.added = 0
+		self.updated = 0
+		self.deleted = 0
+		self.unchanged = 0
+
+	def same_content(self, src, dst):
+		if os.path.getsize(src) != os.path.getsize(dst):
+			return False
+		return self.hash_cache.hash(src) == self.hash_cache.hash(dst)
+
+	def copy(self, src, dst):
+		os.makedirs(os.path.dirname(dst), exist_ok=True)
+		if os.path.isdir(dst):
+			# cp replaces directories by files too
+			shutil.rmtree(dst)
+		shutil.copyfile(src, dst)
+		shutil.copymode(src, dst)
+
+	def delete(self, root, path):
+		os.remove(os.path.join(root, path))
+		# Remove the directories left empty
+		dirname = os.path.dirname(path)
+		while dirname:
+			full_path = os.path.join(root, dirname)
+			if os.listdir(full_path):
+				break
+			os.rmdir(full_path)
+			dirname = os.path.dirname(dirname)
+
+	def sync(self, src_root, dst_root, delete_patterns=()):
+		src_files = list_files(src_root, skip_hidden=True)
+		dst_files = set(list_files(dst_root))
+
+		for path in dst_files - set(src_files):
+			if is_managed(path, delete_patterns):
+				self.delete(dst_root, path)
+				self.deleted += 1
+
+		for path in sorted(src_files):
+			src = os.path.join(src_root, path)
+			dst = os.path.join(dst_root, path)
+			if path not in dst_files:
+				self.copy(src, dst)
+				self.added += 1
+			elif self.same_content(src, dst):
+				if os.stat(src).st_mode != os.stat(dst).st_mode:
+					shutil.copymode(src, dst)
+				self.unchanged += 1
+			else:
+				self.copy(src, dst)
+				self.updated += 1
+
+
+def main():
+	p = ArgumentParser()
+	p.add_argument("src")
+	p.add_argument("dst")
+	p.add_argument(
+		"--delete", nargs="+", default=[], metavar="PATTERN",
+		help="Destination paths to delete when they are not in the source (eg. DBF, *.cs)"
+	)
+	p.add_argument(
+		"--hash-cache", type=str, default=os.path.join(BUILDDIR, "commit-history.cache"),
+		help="Where to keep the hashes of the files between runs"
+	)
+	p.add_argument("--no-hash-cache", action="store_true")
+	args = p.parse_args()
+
+	hash_cache = HashCache(None if args.no_hash_cache else args.hash_cache)
+	tree_sync = TreeSync(hash_cache)
+	tree_sync.sync(args.src, args.dst, args.delete)
+	hash_cache.save()
+
+	print("Synced %s: %i added, %i updated, %i deleted, %i unchanged" % (
+		args.dst, tree_sync.added, tree_sync.updated, tree_sync.deleted, tree_sync.unchanged
+	))
+
+
+if __name__ == "__main__":
+	main()